@@ -3,10 +3,11 @@ import numpy as np
 import pandas as pd
 import os
 import argparse
+import ast
 import trfl
 from utility import *
+from CaserModules import *
 import time
-from joblib import Parallel,delayed
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Caser.")
@@ -27,13 +28,23 @@ def parse_args():
                         help='reward for the purchase behavior.')
     parser.add_argument('--lr', type=float, default=0.005,
                         help='Learning rate.')
+    parser.add_argument('--eval_batch', type=int, default=100,
+                        help='Test sessions per evaluation batch.')
     parser.add_argument('--num_filters', type=int, default=16,
                         help='Number of filters per filter size (default: 128)')
     parser.add_argument('--filter_sizes', nargs='?', default='[2,3,4]',
                         help='Specify the filter_size')
+    parser.add_argument('--conv_impl', choices=['fused', 'per_width'], default='fused',
+                        help='fused: all filter sizes in one matmul over shared windows, per_width: one conv2d each.')
     parser.add_argument('--dropout_rate', default=0.1, type=float)
     parser.add_argument('--out', type=str, help='log file name')
     parser.add_argument('--gpu', type=str, help='gpu id')  
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints',
+                        help='directory for the periodic checkpoints, one subdirectory per --out.')
+    parser.add_argument('--checkpoint_every', type=int, default=0,
+                        help='checkpoint every N training steps, 0 disables checkpointing.')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the latest checkpoint of this run.')
     return parser.parse_args()
 
 
@@ -54,55 +65,13 @@ class Caser:
 
         self.input_emb=tf.nn.embedding_lookup(all_embeddings['state_embeddings'],self.inputs)
         self.input_emb*=mask
-        self.embedded_chars_expanded = tf.expand_dims(self.input_emb, -1)
 
-        # Create a convolution + maxpool layer for each filter size
-        pooled_outputs = []
-        num_filters=args.num_filters
-        filter_sizes=eval(args.filter_sizes)
-        for i, filter_size in enumerate(filter_sizes):
-            with tf.name_scope("conv-maxpool-%s" % filter_size):
-                # Convolution Layer
-                filter_shape = [filter_size, self.hidden_size, 1, num_filters]
-                W = tf.Variable(tf.truncated_normal(filter_shape, stddev=0.1), name="W")
-                b = tf.Variable(tf.constant(0.1, shape=[num_filters]), name="b")
-
-                conv = tf.nn.conv2d(
-                    self.embedded_chars_expanded,
-                    W,
-                    strides=[1, 1, 1, 1],
-                    padding="VALID",
-                    name="conv")
-                # Apply nonlinearity
-                h = tf.nn.relu(tf.nn.bias_add(conv, b), name="relu")
-                # Maxpooling over the outputs
-                # new shape after max_pool[?, 1, 1, num_filters]
-                # be carefyul, the  new_sequence_length has changed because of wholesession[:, 0:-1]
-                pooled = tf.nn.max_pool(
-                    h,
-                    ksize=[1, state_size - filter_size + 1, 1, 1],
-                    strides=[1, 1, 1, 1],
-                    padding='VALID',
-                    name="pool")
-                pooled_outputs.append(pooled)
-
-        # Combine all the pooled features
-        num_filters_total = num_filters * len(filter_sizes)
-        self.h_pool = tf.concat(pooled_outputs, 3)
-        self.h_pool_flat = tf.reshape(self.h_pool, [-1, num_filters_total])  # shape=[batch_size, 384]
-        # design the veritcal cnn
-        with tf.name_scope("conv-verical"):
-            filter_shape = [self.state_size, 1, 1, 1]
-            W = tf.Variable(tf.truncated_normal(filter_shape, stddev=0.1), name="W")
-            b = tf.Variable(tf.constant(0.1, shape=[1]), name="b")
-            conv = tf.nn.conv2d(
-                self.embedded_chars_expanded,
-                W,
-                strides=[1, 1, 1, 1],
-                padding="VALID",
-                name="conv")
-            h = tf.nn.relu(tf.nn.bias_add(conv, b), name="relu")
-        self.vcnn_flat = tf.reshape(h, [-1, self.hidden_size])
+        # horizontal convolutions of every filter size, then the vertical one
+        filter_sizes = ast.literal_eval(args.filter_sizes)
+        self.h_pool_flat = horizontal_conv(self.input_emb, filter_sizes, args.num_filters, state_size,
+                                           self.hidden_size, fused=args.conv_impl == 'fused')
+        self.vcnn_flat = vertical_conv(self.input_emb, self.state_size, self.hidden_size,
+                                       fused=args.conv_impl == 'fused')
         self.final = tf.concat([self.h_pool_flat, self.vcnn_flat], 1)  # shape=[batch_size, 384+100]
 
         # Add dropout
@@ -112,6 +81,9 @@ class Caser:
                                      training=tf.convert_to_tensor(self.is_training))
         # self.state_hidden=self.final
         self.output = tf.contrib.layers.fully_connected(self.state_hidden,self.item_num,activation_fn=None,scope='fc')
+        # rank of the target item among all logits, so evaluation fetches only [batch] ints
+        self.eval_targets = tf.placeholder(tf.int32, [None])
+        self.target_rank = target_rank_op(self.output, self.eval_targets)
 
         self.loss=tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.target,logits=self.output)
         self.loss = tf.reduce_mean(self.loss)
@@ -126,57 +98,28 @@ class Caser:
         return all_embeddings
 
 def evaluate(sess):
-    eval_sessions=pd.read_pickle(os.path.join(data_directory, 'sampled_test.df'))
-    eval_ids = eval_sessions.session_id.unique()
-    groups = eval_sessions.groupby('session_id')
-    batch = 100
+    session_offsets = eval_data['session_offsets']
+    num_sessions = len(session_offsets) - 1
+    batch = args.eval_batch
     evaluated=0
-    total_clicks=0.0
-    total_purchase = 0.0
+    total_clicks = float(np.sum(eval_data['is_buy'] != 1))
+    total_purchase = float(np.sum(eval_data['is_buy'] == 1))
     total_reward = [0, 0, 0, 0]
     hit_clicks=[0,0,0,0]
     ndcg_clicks=[0,0,0,0]
     hit_purchase=[0,0,0,0]
     ndcg_purchase=[0,0,0,0]
-    while evaluated<len(eval_ids):
-        states, len_states, actions, rewards = [], [], [], []
-        for i in range(batch):
-            if evaluated==len(eval_ids):
-                break
-            id=eval_ids[evaluated]
-            group=groups.get_group(id)
-            history=[]
-            for index, row in group.iterrows():
-                state=list(history)
-                len_states.append(state_size if len(state)>=state_size else 1 if len(state)==0 else len(state))
-                state=pad_history(state,state_size,item_num)
-                states.append(state)
-                action=row['item_id']
-                is_buy=row['is_buy']
-                reward = reward_buy if is_buy == 1 else reward_click
-                if is_buy==1:
-                    total_purchase+=1.0
-                else:
-                    total_clicks+=1.0
-                actions.append(action)
-                rewards.append(reward)
-                history.append(row['item_id'])
-            evaluated+=1
-        prediction=sess.run(CaserRec.output, feed_dict={CaserRec.inputs: states,CaserRec.len_state:len_states,CaserRec.is_training:False})
-        n_jobs = len(prediction) // 30 + 1
-        if n_jobs > 4:
-            n_jobs = 4
-
-        res = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(np.argsort)(part) for part in np.array_split(prediction, n_jobs))
-        FirstIter = True
-        sorted_list = None
-        for part in res:
-            if FirstIter:
-                sorted_list = np.copy(part)
-                FirstIter = False
-            else:
-                sorted_list = np.concatenate([sorted_list, part])
-        calculate_hit(sorted_list,topk,actions,rewards,reward_click,total_reward,hit_clicks,ndcg_clicks,hit_purchase,ndcg_purchase)
+    while evaluated<num_sessions:
+        # each batch is a slice of `batch` whole sessions of the compiled test set
+        begin = session_offsets[evaluated]
+        evaluated = min(evaluated + batch, num_sessions)
+        end = session_offsets[evaluated]
+        states = eval_data['states'][begin:end]
+        len_states = eval_data['len_states'][begin:end]
+        actions = eval_data['actions'][begin:end]
+        rewards = np.where(eval_data['is_buy'][begin:end] == 1, reward_buy, reward_click)
+        ranks=sess.run(CaserRec.target_rank, feed_dict={CaserRec.inputs: states,CaserRec.len_state:len_states,CaserRec.is_training:False,CaserRec.eval_targets:actions})
+        calculate_rank_hit(ranks,topk,rewards,reward_click,total_reward,hit_clicks,ndcg_clicks,hit_purchase,ndcg_purchase)
     print('#############################################################')
     print('total clicks: %d, total purchase:%d' % (total_clicks, total_purchase))
     best_rec = [[0,0,0,0,0], [0,0,0,0,0], [0,0,0,0,0], [0,0,0,0,0]]
@@ -212,6 +155,7 @@ if __name__ == '__main__':
     reward_click = args.r_click
     reward_buy = args.r_buy
     topk=[5,10,15,20]
+    eval_data = compile_eval_data(data_directory, state_size, item_num)
     # save_file = 'pretrain-GRU/%d' % (hidden_size)
 
     tf.reset_default_graph()
@@ -232,11 +176,17 @@ if __name__ == '__main__':
     with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
         # Initialize variables
         sess.run(tf.global_variables_initializer())
+        checkpointer = Checkpointer(sess, os.path.join(args.checkpoint_dir, args.out), args.checkpoint_every)
+        if args.resume:
+            total_step = checkpointer.restore(log_data=log_data, total_score_rec=total_score_rec)
         # evaluate(sess)
         num_rows=replay_buffer.shape[0]
         num_batches=int(num_rows/args.batch_size)
         for i in range(args.epoch):
             for j in range(num_batches):
+                if i * num_batches + j < total_step:
+                    continue  # already trained before resuming
+                checkpointer.maybe_save(total_step, log_data=log_data, total_score_rec=total_score_rec)
                 batch = replay_buffer.sample(n=args.batch_size).to_dict()
                 state = list(batch['state'].values())
                 len_state = list(batch['len_state'].values())
@@ -259,6 +209,7 @@ if __name__ == '__main__':
                     total_score_rec.append(np.round(total_score, 3))
                     print('total score rec ', pd.DataFrame(total_score_rec))
                     log_data.append(log_data_one_eval)
+        checkpointer.finish(total_step, log_data=log_data, total_score_rec=total_score_rec)
         log_data = pd.DataFrame(log_data, columns=column_name)
         log_data.to_csv('log_data/' + args.out + '.csv')
         print('write log done')
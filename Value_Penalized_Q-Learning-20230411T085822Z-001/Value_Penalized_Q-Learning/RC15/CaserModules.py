@@ -0,0 +1,61 @@
+import numpy as np
+import tensorflow as tf
+
+
+def horizontal_conv(input_emb, filter_sizes, num_filters, state_size, hidden_size, fused=True):
+    '''Caser horizontal convolutions, max-pooled over time, [N, num_filters * len(filter_sizes)].
+
+    Every filter size keeps its own W [filter_size, hidden, 1, num_filters]
+    and b variables under "conv-maxpool-<size>". The fused path runs all the
+    sizes as one matmul over the shared sliding windows of max(filter_sizes)
+    items: each W is zero-padded to the widest window, and the positions
+    where a narrower filter would run past the sequence are masked before
+    the max. Since the outputs are relus, masking with 0 keeps the max of
+    the valid positions. Without `fused` each size gets its own conv2d and
+    max_pool.
+    '''
+    weights = []
+    for filter_size in filter_sizes:
+        with tf.name_scope("conv-maxpool-%s" % filter_size):
+            filter_shape = [filter_size, hidden_size, 1, num_filters]
+            W = tf.Variable(tf.truncated_normal(filter_shape, stddev=0.1), name="W")
+            b = tf.Variable(tf.constant(0.1, shape=[num_filters]), name="b")
+            weights.append((W, b))
+
+    if not fused:
+        embedded_chars_expanded = tf.expand_dims(input_emb, -1)
+        pooled_outputs = []
+        for filter_size, (W, b) in zip(filter_sizes, weights):
+            with tf.name_scope("conv-maxpool-%s" % filter_size):
+                conv = tf.nn.conv2d(embedded_chars_expanded, W, strides=[1, 1, 1, 1], padding="VALID", name="conv")
+                h = tf.nn.relu(tf.nn.bias_add(conv, b), name="relu")
+                pooled = tf.nn.max_pool(h, ksize=[1, state_size - filter_size + 1, 1, 1], strides=[1, 1, 1, 1],
+                                        padding='VALID', name="pool")
+                pooled_outputs.append(pooled)
+        return tf.reshape(tf.concat(pooled_outputs, 3), [-1, num_filters * len(filter_sizes)])
+
+    with tf.name_scope("conv-maxpool-fused"):
+        max_size = max(filter_sizes)
+        padded = tf.pad(input_emb, [[0, 0], [0, max_size - 1], [0, 0]])
+        windows = tf.concat([padded[:, j:j + state_size, :] for j in range(max_size)], axis=2)  # [N, T, max_size*H]
+        kernel = tf.concat([tf.pad(tf.reshape(W, [filter_size * hidden_size, num_filters]),
+                                   [[0, (max_size - filter_size) * hidden_size], [0, 0]])
+                            for filter_size, (W, _) in zip(filter_sizes, weights)], axis=1)
+        bias = tf.concat([b for _, b in weights], axis=0)
+        h = tf.nn.relu(tf.tensordot(windows, kernel, axes=1) + bias)  # [N, T, num_filters * len(filter_sizes)]
+        valid = np.concatenate([np.repeat((np.arange(state_size) <= state_size - filter_size)[:, None],
+                                          num_filters, axis=1) for filter_size in filter_sizes], axis=1)
+        return tf.reduce_max(h * tf.constant(valid, dtype=tf.float32), axis=1)
+
+
+def vertical_conv(input_emb, state_size, hidden_size, fused=True):
+    '''Caser vertical convolution, a learned weighting of the state_size positions, [N, hidden].'''
+    with tf.name_scope("conv-verical"):
+        filter_shape = [state_size, 1, 1, 1]
+        W = tf.Variable(tf.truncated_normal(filter_shape, stddev=0.1), name="W")
+        b = tf.Variable(tf.constant(0.1, shape=[1]), name="b")
+        if fused:
+            return tf.nn.relu(tf.tensordot(input_emb, tf.reshape(W, [state_size]), axes=[[1], [0]]) + b)
+        conv = tf.nn.conv2d(tf.expand_dims(input_emb, -1), W, strides=[1, 1, 1, 1], padding="VALID", name="conv")
+        h = tf.nn.relu(tf.nn.bias_add(conv, b), name="relu")
+    return tf.reshape(h, [-1, hidden_size])
@@ -2,13 +2,14 @@ import os
 import trfl
 import time
 import argparse
+import ast
 import numpy as np
 import pandas as pd
 from utility import *
+from CaserModules import *
 import tensorflow as tf
 from collections import deque
 from trfl import indexing_ops
-from joblib import Parallel,delayed
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Caser-AC-Minus.")
@@ -29,10 +30,14 @@ def parse_args():
                         help='reward for the purchase behavior.')
     parser.add_argument('--lr', type=float, default=0.005,
                         help='Learning rate.')
+    parser.add_argument('--eval_batch', type=int, default=100,
+                        help='Test sessions per evaluation batch.')
     parser.add_argument('--num_filters', type=int, default=16,
                         help='Number of filters per filter size (default: 128)')
     parser.add_argument('--filter_sizes', nargs='?', default='[2,3,4]',
                         help='Specify the filter_size')
+    parser.add_argument('--conv_impl', choices=['fused', 'per_width'], default='fused',
+                        help='fused: all filter sizes in one matmul over shared windows, per_width: one conv2d each.')
     parser.add_argument('--discount', type=float, default=0.5,
                         help='Discount factor for RL.')
     parser.add_argument('--dropout_rate', default=0.1, type=float)
@@ -41,12 +46,26 @@ def parse_args():
     parser.add_argument('--method', type=str, default='unspecified')
     parser.add_argument('--coef', type=float, default=0)
     parser.add_argument('--num_multi_head', type=int, default=15)
+    parser.add_argument('--target_sync', type=str, default='double',
+                        help='double: train both networks, picking the main one at random each step; '
+                             'hard: train one network and copy it to a frozen target every --sync_every steps; '
+                             'polyak: train one network and average it into the target every step with --tau.')
+    parser.add_argument('--sync_every', type=int, default=1000,
+                        help='Steps between target copies for --target_sync hard.')
+    parser.add_argument('--tau', type=float, default=0.005,
+                        help='Averaging rate for --target_sync polyak.')
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints',
+                        help='directory for the periodic checkpoints, one subdirectory per --out.')
+    parser.add_argument('--checkpoint_every', type=int, default=0,
+                        help='checkpoint every N training steps, 0 disables checkpointing.')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the latest checkpoint of this run.')
     return parser.parse_args()
 
 
 class Caser:
     def __init__(self, hidden_size, learning_rate, item_num, state_size, coef, num_multi_head,
-                name='CaserRec', method='unspecified'):
+                name='CaserRec', method='unspecified', trainable=True):
         self.state_size = state_size
         self.learning_rate = learning_rate
         self.hidden_size=hidden_size
@@ -68,55 +87,13 @@ class Caser:
 
             self.input_emb = tf.nn.embedding_lookup(self.all_embeddings['state_embeddings'], self.inputs)
             self.input_emb *= mask
-            self.embedded_chars_expanded = tf.expand_dims(self.input_emb, -1)
 
-            # Create a convolution + maxpool layer for each filter size
-            pooled_outputs = []
-            num_filters = args.num_filters
-            filter_sizes = eval(args.filter_sizes)
-            for i, filter_size in enumerate(filter_sizes):
-                with tf.name_scope("conv-maxpool-%s" % filter_size):
-                    # Convolution Layer
-                    filter_shape = [filter_size, self.hidden_size, 1, num_filters]
-                    W = tf.Variable(tf.truncated_normal(filter_shape, stddev=0.1), name="W")
-                    b = tf.Variable(tf.constant(0.1, shape=[num_filters]), name="b")
-
-                    conv = tf.nn.conv2d(
-                        self.embedded_chars_expanded,
-                        W,
-                        strides=[1, 1, 1, 1],
-                        padding="VALID",
-                        name="conv")
-                    # Apply nonlinearity
-                    h = tf.nn.relu(tf.nn.bias_add(conv, b), name="relu")
-                    # Maxpooling over the outputs
-                    # new shape after max_pool[?, 1, 1, num_filters]
-                    # be carefyul, the  new_sequence_length has changed because of wholesession[:, 0:-1]
-                    pooled = tf.nn.max_pool(
-                        h,
-                        ksize=[1, state_size - filter_size + 1, 1, 1],
-                        strides=[1, 1, 1, 1],
-                        padding='VALID',
-                        name="pool")
-                    pooled_outputs.append(pooled)
-
-            # Combine all the pooled features
-            num_filters_total = num_filters * len(filter_sizes)
-            self.h_pool = tf.concat(pooled_outputs, 3)
-            self.h_pool_flat = tf.reshape(self.h_pool, [-1, num_filters_total])  # shape=[batch_size, 384]
-            # design the veritcal cnn
-            with tf.name_scope("conv-verical"):
-                filter_shape = [self.state_size, 1, 1, 1]
-                W = tf.Variable(tf.truncated_normal(filter_shape, stddev=0.1), name="W")
-                b = tf.Variable(tf.constant(0.1, shape=[1]), name="b")
-                conv = tf.nn.conv2d(
-                    self.embedded_chars_expanded,
-                    W,
-                    strides=[1, 1, 1, 1],
-                    padding="VALID",
-                    name="conv")
-                h = tf.nn.relu(tf.nn.bias_add(conv, b), name="relu")
-            self.vcnn_flat = tf.reshape(h, [-1, self.hidden_size])
+            # horizontal convolutions of every filter size, then the vertical one
+            filter_sizes = ast.literal_eval(args.filter_sizes)
+            self.h_pool_flat = horizontal_conv(self.input_emb, filter_sizes, args.num_filters, state_size,
+                                               self.hidden_size, fused=args.conv_impl == 'fused')
+            self.vcnn_flat = vertical_conv(self.input_emb, self.state_size, self.hidden_size,
+                                           fused=args.conv_impl == 'fused')
             self.final = tf.concat([self.h_pool_flat, self.vcnn_flat], 1)  # shape=[batch_size, 384+100]
 
             # Add dropout
@@ -152,6 +129,9 @@ class Caser:
 
             self.output2 = tf.contrib.layers.fully_connected(self.state_hidden, self.item_num,
                                                              activation_fn=None, scope="ce-logits")  # all ce logits
+            # rank of the target item among all logits, so evaluation fetches only [batch] ints
+            self.eval_targets = tf.placeholder(tf.int32, [None])
+            self.target_rank = target_rank_op(self.output2, self.eval_targets)
             # TRFL way
             self.actions = tf.placeholder(tf.int32, [None])
             self.targetQs_ = tf.placeholder(tf.float32, [None, item_num])
@@ -172,7 +152,12 @@ class Caser:
             self.ce_loss = tf.reduce_mean(celoss)
 
             self.loss = tf.reduce_mean(qloss + celoss)
-            self.opt = tf.train.AdamOptimizer(learning_rate).minimize(self.loss)
+            if trainable:
+                # a frozen target copy gets no optimizer and no Adam slots; its variables stay in
+                # TRAINABLE_VARIABLES, where target_update_op and the offline evaluator find them,
+                # so every update is restricted to the variables of this network
+                self.opt = tf.train.AdamOptimizer(learning_rate).minimize(
+                    self.loss, var_list=tf.trainable_variables(self.name + '/'))
 
 
     def initialize_embeddings(self):
@@ -183,57 +168,28 @@ class Caser:
         return all_embeddings
 
 def evaluate(sess):
-    eval_sessions=pd.read_pickle(os.path.join(data_directory, 'sampled_test.df'))
-    eval_ids = eval_sessions.session_id.unique()
-    groups = eval_sessions.groupby('session_id')
-    batch = 100
+    session_offsets = eval_data['session_offsets']
+    num_sessions = len(session_offsets) - 1
+    batch = args.eval_batch
     evaluated=0
-    total_clicks=0.0
-    total_purchase = 0.0
+    total_clicks = float(np.sum(eval_data['is_buy'] != 1))
+    total_purchase = float(np.sum(eval_data['is_buy'] == 1))
     total_reward = [0, 0, 0, 0]
     hit_clicks=[0,0,0,0]
     ndcg_clicks=[0,0,0,0]
     hit_purchase=[0,0,0,0]
     ndcg_purchase=[0,0,0,0]
-    while evaluated<len(eval_ids):
-        states, len_states, actions, rewards = [], [], [], []
-        for i in range(batch):
-            if evaluated==len(eval_ids):
-                break
-            id=eval_ids[evaluated]
-            group=groups.get_group(id)
-            history=[]
-            for index, row in group.iterrows():
-                state=list(history)
-                len_states.append(state_size if len(state)>=state_size else 1 if len(state)==0 else len(state))
-                state=pad_history(state,state_size,item_num)
-                states.append(state)
-                action=row['item_id']
-                is_buy=row['is_buy']
-                reward = reward_buy if is_buy == 1 else reward_click
-                if is_buy==1:
-                    total_purchase+=1.0
-                else:
-                    total_clicks+=1.0
-                actions.append(action)
-                rewards.append(reward)
-                history.append(row['item_id'])
-            evaluated+=1
-        prediction=sess.run(CaserRec1.output2, feed_dict={CaserRec1.inputs: states,CaserRec1.len_state:len_states,CaserRec1.is_training:False})
-        n_jobs = len(prediction) // 36 + 1
-        if n_jobs > 12:
-            n_jobs = 12
-
-        res = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(np.argsort)(part) for part in np.array_split(prediction, n_jobs))
-        FirstIter = True
-        sorted_list = None
-        for part in res:
-            if FirstIter:
-                sorted_list = np.copy(part)
-                FirstIter = False
-            else:
-                sorted_list = np.concatenate([sorted_list, part])
-        calculate_hit(sorted_list,topk,actions,rewards,reward_click,total_reward,hit_clicks,ndcg_clicks,hit_purchase,ndcg_purchase)
+    while evaluated<num_sessions:
+        # each batch is a slice of `batch` whole sessions of the compiled test set
+        begin = session_offsets[evaluated]
+        evaluated = min(evaluated + batch, num_sessions)
+        end = session_offsets[evaluated]
+        states = eval_data['states'][begin:end]
+        len_states = eval_data['len_states'][begin:end]
+        actions = eval_data['actions'][begin:end]
+        rewards = np.where(eval_data['is_buy'][begin:end] == 1, reward_buy, reward_click)
+        ranks=sess.run(CaserRec1.target_rank, feed_dict={CaserRec1.inputs: states,CaserRec1.len_state:len_states,CaserRec1.is_training:False,CaserRec1.eval_targets:actions})
+        calculate_rank_hit(ranks,topk,rewards,reward_click,total_reward,hit_clicks,ndcg_clicks,hit_purchase,ndcg_purchase)
     best_rec = [[0,0,0,0,0], [0,0,0,0,0], [0,0,0,0,0], [0,0,0,0,0]]
     for i in range(len(topk)):
         hr_click=hit_clicks[i]/total_clicks
@@ -267,6 +223,7 @@ if __name__ == '__main__':
     reward_click = args.r_click
     reward_buy = args.r_buy
     topk=[5,10,15,20]
+    eval_data = compile_eval_data(data_directory, state_size, item_num)
     # save_file = 'pretrain-GRU/%d' % (hidden_size)
 
     tf.reset_default_graph()
@@ -278,7 +235,12 @@ if __name__ == '__main__':
     CaserRec2 = Caser(hidden_size=args.hidden_factor, learning_rate=args.lr, 
                     item_num=item_num, state_size=state_size, coef=args.coef,
                     num_multi_head=args.num_multi_head,
-                    name='CaserRec2', method=args.method)
+                    name='CaserRec2', trainable=args.target_sync == 'double', method=args.method)
+
+    if args.target_sync != 'double':
+        # CaserRec1 is the only trained network, CaserRec2 its periodically synced target copy
+        target_copy_op = target_update_op(CaserRec1.name, CaserRec2.name)
+        target_polyak_op = target_update_op(CaserRec1.name, CaserRec2.name, args.tau)
 
     replay_buffer = pd.read_pickle(os.path.join(data_directory, 'replay_buffer.df'))
 
@@ -293,17 +255,28 @@ if __name__ == '__main__':
     with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
         # Initialize variables
         sess.run(tf.global_variables_initializer())
+        checkpointer = Checkpointer(sess, os.path.join(args.checkpoint_dir, args.out), args.checkpoint_every)
+        if args.resume:
+            total_step = checkpointer.restore(log_data=log_data, total_score_rec=total_score_rec)
         # evaluate(sess)
         num_rows=replay_buffer.shape[0]
         num_batches=int(num_rows/args.batch_size)
         print('epoch = {}    num_batches = {}'.format(args.epoch, num_batches))
         for i in range(args.epoch):
             for j in range(num_batches):
+                if i * num_batches + j < total_step:
+                    continue  # already trained before resuming
+                if args.target_sync == 'hard' and total_step % args.sync_every == 0 or \
+                        args.target_sync == 'polyak' and total_step == 0:
+                    sess.run(target_copy_op)
+                elif args.target_sync == 'polyak':
+                    sess.run(target_polyak_op)
+                checkpointer.maybe_save(total_step, log_data=log_data, total_score_rec=total_score_rec)
                 batch = replay_buffer.sample(n=args.batch_size).to_dict()
                 next_state = list(batch['next_state'].values())
                 len_next_state = list(batch['len_next_states'].values())
                 # double q learning, pointer is for selecting which network  is target and which is main
-                pointer = np.random.randint(0, 2)
+                pointer = np.random.randint(0, 2) if args.target_sync == 'double' else 0
                 if pointer == 0:
                     mainQN = CaserRec1
                     target_QN = CaserRec2
@@ -369,6 +342,7 @@ if __name__ == '__main__':
                         total_score_rec.append(np.round(total_score, 3))
                         print('total score rec ', total_score_rec)
                         log_data.append(log_data_one_eval)   
+        checkpointer.finish(total_step, log_data=log_data, total_score_rec=total_score_rec)
         log_data = pd.DataFrame(log_data, columns=column_name)
         log_data.to_csv('log_data/' + args.out + '.csv')
         print('time used in Caser_AC :', time.time() - start_time)
\ No newline at end of file
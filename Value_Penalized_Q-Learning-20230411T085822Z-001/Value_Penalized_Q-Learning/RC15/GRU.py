@@ -4,9 +4,8 @@ import pandas as pd
 import os
 import argparse
 import trfl
-from utility import pad_history,calculate_hit
+from utility import pad_history,calculate_hit,Checkpointer
 import time
-from joblib import Parallel,delayed
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Run supervised GRU.")
@@ -27,8 +26,16 @@ def parse_args():
                         help='reward for the purchase behavior.')
     parser.add_argument('--lr', type=float, default=0.005,
                         help='Learning rate.')
+    parser.add_argument('--eval_batch', type=int, default=100,
+                        help='Test sessions per evaluation batch.')
     parser.add_argument('--out', type=str, help='log file name')
     parser.add_argument('--gpu', type=str, help='gpu id', default=0)
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints',
+                        help='directory for the periodic checkpoints, one subdirectory per --out.')
+    parser.add_argument('--checkpoint_every', type=int, default=0,
+                        help='checkpoint every N training steps, 0 disables checkpointing.')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the latest checkpoint of this run.')
     return parser.parse_args()
 
 
@@ -55,6 +62,9 @@ class GRUnetwork:
         )
 
         self.output = tf.contrib.layers.fully_connected(self.states_hidden,self.item_num,activation_fn=None,scope='fc')
+        # rank of the target item among all logits, so evaluation fetches only [batch] ints
+        self.eval_targets = tf.placeholder(tf.int32, [None])
+        self.target_rank = target_rank_op(self.output, self.eval_targets)
 
         self.loss=tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.target,logits=self.output)
         self.loss = tf.reduce_mean(self.loss)
@@ -69,56 +79,28 @@ class GRUnetwork:
         return all_embeddings
 
 def evaluate(sess):
-    eval_sessions=pd.read_pickle(os.path.join(data_directory, 'sampled_test.df'))
-    eval_ids = eval_sessions.session_id.unique()
-    groups = eval_sessions.groupby('session_id')
-    batch = 100
+    session_offsets = eval_data['session_offsets']
+    num_sessions = len(session_offsets) - 1
+    batch = args.eval_batch
     evaluated=0
-    total_clicks=0.0
-    total_purchase = 0.0
+    total_clicks = float(np.sum(eval_data['is_buy'] != 1))
+    total_purchase = float(np.sum(eval_data['is_buy'] == 1))
     total_reward = [0, 0, 0, 0]
     hit_clicks=[0,0,0,0]
     ndcg_clicks=[0,0,0,0]
     hit_purchase=[0,0,0,0]
     ndcg_purchase=[0,0,0,0]
-    while evaluated<len(eval_ids):
-        states, len_states, actions, rewards = [], [], [], []
-        for i in range(batch):
-            if evaluated==len(eval_ids):
-                break
-            id=eval_ids[evaluated]
-            group=groups.get_group(id)
-            history=[]
-            for index, row in group.iterrows():
-                state=list(history)
-                len_states.append(state_size if len(state)>=state_size else 1 if len(state)==0 else len(state))
-                state=pad_history(state,state_size,item_num)
-                states.append(state)
-                action=row['item_id']
-                is_buy=row['is_buy']
-                reward = reward_buy if is_buy == 1 else reward_click
-                if is_buy==1:
-                    total_purchase+=1.0
-                else:
-                    total_clicks+=1.0
-                actions.append(action)
-                rewards.append(reward)
-                history.append(row['item_id'])
-            evaluated+=1
-        prediction=sess.run(GRUnet.output, feed_dict={GRUnet.inputs: states,GRUnet.len_state:len_states})
-        n_jobs = len(prediction) // 24 + 1
-        if n_jobs > 4:
-            n_jobs = 4
-        res = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(np.argsort)(part) for part in np.array_split(prediction, n_jobs))
-        FirstIter = True
-        sorted_list = None
-        for part in res:
-            if FirstIter:
-                sorted_list = np.copy(part)
-                FirstIter = False
-            else:
-                sorted_list = np.concatenate([sorted_list, part])
-        calculate_hit(sorted_list,topk,actions,rewards,reward_click,total_reward,hit_clicks,ndcg_clicks,hit_purchase,ndcg_purchase)
+    while evaluated<num_sessions:
+        # each batch is a slice of `batch` whole sessions of the compiled test set
+        begin = session_offsets[evaluated]
+        evaluated = min(evaluated + batch, num_sessions)
+        end = session_offsets[evaluated]
+        states = eval_data['states'][begin:end]
+        len_states = eval_data['len_states'][begin:end]
+        actions = eval_data['actions'][begin:end]
+        rewards = np.where(eval_data['is_buy'][begin:end] == 1, reward_buy, reward_click)
+        ranks=sess.run(GRUnet.target_rank, feed_dict={GRUnet.inputs: states,GRUnet.len_state:len_states,GRUnet.eval_targets:actions})
+        calculate_rank_hit(ranks,topk,rewards,reward_click,total_reward,hit_clicks,ndcg_clicks,hit_purchase,ndcg_purchase)
     best_rec = [[0,0,0,0,0], [0,0,0,0,0], [0,0,0,0,0], [0,0,0,0,0]]
     for i in range(len(topk)):
         hr_click=hit_clicks[i]/total_clicks
@@ -150,6 +132,7 @@ if __name__ == '__main__':
     reward_click = args.r_click
     reward_buy = args.r_buy
     topk=[5,10,15,20]
+    eval_data = compile_eval_data(data_directory, state_size, item_num)
     # save_file = 'pretrain-GRU/%d' % (hidden_size)
 
     tf.reset_default_graph()
@@ -169,11 +152,17 @@ if __name__ == '__main__':
     with tf.Session() as sess:
         # Initialize variables
         sess.run(tf.global_variables_initializer())
+        checkpointer = Checkpointer(sess, os.path.join(args.checkpoint_dir, args.out), args.checkpoint_every)
+        if args.resume:
+            total_step = checkpointer.restore(log_data=log_data, total_score_rec=total_score_rec)
         # evaluate(sess)
         num_rows=replay_buffer.shape[0]
         num_batches=int(num_rows/args.batch_size)
         for i in range(args.epoch):
             for j in range(num_batches):
+                if i * num_batches + j < total_step:
+                    continue  # already trained before resuming
+                checkpointer.maybe_save(total_step, log_data=log_data, total_score_rec=total_score_rec)
                 batch = replay_buffer.sample(n=args.batch_size).to_dict()
                 state = list(batch['state'].values())
                 len_state = list(batch['len_state'].values())
@@ -195,6 +184,7 @@ if __name__ == '__main__':
                     total_score_rec.append(np.round(total_score, 3))
                     print('total score record', total_score_rec)
                     log_data.append(log_data_one_eval)
+        checkpointer.finish(total_step, log_data=log_data, total_score_rec=total_score_rec)
     print('time used in GRU :', time.time() - start_time)
     log_data = pd.DataFrame(log_data, columns=column_name)
     log_data.to_csv('log_data/' + args.out + '.csv')
@@ -5,14 +5,15 @@ from utility import *
 # config e.g. dilations: [1,4,16,] In most cases[1,4,] is enough
 def nextitnet_residual_block(input_, dilation, layer_id,
                              residual_channels, kernel_size,
-                             causal=True, train=True):
+                             causal=True, train=True, conv_impl='atrous'):
     resblock_type = "decoder"
     resblock_name = "nextitnet_residual_block{}_layer_{}_{}".format(resblock_type, layer_id, dilation)
     with tf.variable_scope(resblock_name):
         dilated_conv = conv1d(input_, residual_channels,
                               dilation, kernel_size,
                               causal=causal,
-                              name="dilated_conv1"
+                              name="dilated_conv1",
+                              impl=conv_impl
                               )
         input_ln = normalize(dilated_conv, scope="layer_norm1")
         # input_ln=tf.contrib.layers.layer_norm(dilated_conv,reuse=not train, trainable=train)  #performance is not good, paramter wrong?
@@ -21,7 +22,8 @@ def nextitnet_residual_block(input_, dilation, layer_id,
         dilated_conv = conv1d(relu1, residual_channels,
                               2 * dilation, kernel_size,
                               causal=causal,
-                              name="dilated_conv2"
+                              name="dilated_conv2",
+                              impl=conv_impl
                               )
 
         input_ln = normalize(dilated_conv, scope="layer_norm2")
@@ -33,7 +35,11 @@ def nextitnet_residual_block(input_, dilation, layer_id,
 
 def conv1d(input_, output_channels,
            dilation=1, kernel_size=1, causal=False,
-           name="dilated_conv"):
+           name="dilated_conv", impl='atrous'):
+    # causal implementations, all with the same [1, kernel_size, in, out] weight:
+    #   atrous: 4-D tf.nn.atrous_conv2d over the expanded input
+    #   native: 1-D tf.nn.convolution with dilation_rate
+    #   im2col: the kernel_size dilated taps concatenated and one matmul
     with tf.variable_scope(name):
         weight = tf.get_variable('weight', [1, kernel_size, input_.get_shape()[-1], output_channels],
                                  initializer=tf.truncated_normal_initializer(stddev=0.02, seed=1))
@@ -43,6 +49,14 @@ def conv1d(input_, output_channels,
         if causal:
             padding = [[0, 0], [(kernel_size - 1) * dilation, 0], [0, 0]]
             padded = tf.pad(input_, padding)
+            if impl == 'native':
+                return tf.nn.convolution(padded, weight[0], padding='VALID', dilation_rate=[dilation]) + bias
+            if impl == 'im2col':
+                length = tf.shape(input_)[1]
+                taps = tf.concat([padded[:, j * dilation:j * dilation + length, :] for j in range(kernel_size)], axis=2)
+                in_channels = input_.get_shape()[-1].value
+                kernel = tf.reshape(weight, [kernel_size * in_channels, output_channels])
+                return tf.tensordot(taps, kernel, axes=1) + bias
             input_expanded = tf.expand_dims(padded, dim=1)
             out = tf.nn.atrous_conv2d(input_expanded, weight, rate=dilation, padding='VALID') + bias
         else:
@@ -8,7 +8,6 @@ from utility import *
 import tensorflow as tf
 from NextItNetModules import *
 from trfl import indexing_ops
-from joblib import Parallel,delayed
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Next-AC-CQL.")
@@ -26,19 +25,43 @@ def parse_args():
                         help='reward for the purchase behavior.')
     parser.add_argument('--lr', type=float, default=0.005,
                         help='Learning rate.') # 0.005 for batchsize  = 256
+    parser.add_argument('--eval_batch', type=int, default=100,
+                        help='Test sessions per evaluation batch.')
+    parser.add_argument('--conv_impl', choices=['atrous', 'native', 'im2col'], default='atrous',
+                        help='causal dilated convolution implementation, see benchmark.py --op dilated_conv.')
     parser.add_argument('--discount', type=float, default=0.5,
                         help='Discount factor for RL.')
     parser.add_argument('--out', type=str, help='log file name')
     parser.add_argument('--gpu', type=str, help='gpu id')        
     parser.add_argument('--method', type=str, default='unspecified')
     parser.add_argument('--num_multi_head', type=int, default=15)
+    parser.add_argument('--candidate_targets', type=int, default=0,
+                        help='1: restrict the target argmax to a per-batch candidate set; 0: use all items.')
+    parser.add_argument('--num_popular', type=int, default=1000,
+                        help='Number of popular items in the target candidate set.')
+    parser.add_argument('--num_negatives', type=int, default=1000,
+                        help='Number of sampled items in the target candidate set.')
     parser.add_argument('--CQL_weight', type=float, default=0.1)
+    parser.add_argument('--target_sync', type=str, default='double',
+                        help='double: train both networks, picking the main one at random each step; '
+                             'hard: train one network and copy it to a frozen target every --sync_every steps; '
+                             'polyak: train one network and average it into the target every step with --tau.')
+    parser.add_argument('--sync_every', type=int, default=1000,
+                        help='Steps between target copies for --target_sync hard.')
+    parser.add_argument('--tau', type=float, default=0.005,
+                        help='Averaging rate for --target_sync polyak.')
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints',
+                        help='directory for the periodic checkpoints, one subdirectory per --out.')
+    parser.add_argument('--checkpoint_every', type=int, default=0,
+                        help='checkpoint every N training steps, 0 disables checkpointing.')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the latest checkpoint of this run.')
     return parser.parse_args()
 
 
 class NextItNet:
     def __init__(self, hidden_size, learning_rate, item_num, state_size, num_multi_head,
-                name='NextRec-CQL'):
+                name='NextRec-CQL', trainable=True):
         self.state_size = state_size
         self.learning_rate = learning_rate
         self.hidden_size=hidden_size
@@ -74,7 +97,8 @@ class NextItNet:
                 dilate_output = nextitnet_residual_block(dilate_output, dilation,
                                                         layer_id, self.model_para['dilated_channels'],
                                                         self.model_para['kernel_size'], 
-                                                        causal=True, train=self.is_training)
+                                                        causal=True, train=self.is_training,
+                                                        conv_impl=args.conv_impl)
                 dilate_output *= mask
             # state_hidden 64-D
             self.state_hidden = extract_axis_1(dilate_output, self.len_state - 1)
@@ -86,15 +110,25 @@ class NextItNet:
                                                                 self.item_num, self.num_multi_head))
             out_rem = multi_head_output * tf.reshape(self.rco, [1,1,-1])
             self.output1 = tf.math.reduce_sum(out_rem, axis=-1) 
+            # Q-values of the candidate items only, for the bootstrap targets
+            self.candidates = tf.placeholder(tf.int32, [None], name='candidates')
+            cand_multi_head_output = candidate_multi_head_output(self.state_hidden, self.candidates,
+                                                                 self.num_multi_head)
+            self.output1_candidates = tf.math.reduce_sum(cand_multi_head_output * tf.reshape(self.rco, [1,1,-1]),
+                                                        axis=-1)
 
             self.output2 = tf.contrib.layers.fully_connected(self.state_hidden, self.item_num,
                                                              activation_fn=None, scope="ce-logits")  # all ce logits
+            # rank of the target item among all logits, so evaluation fetches only [batch] ints
+            self.eval_targets = tf.placeholder(tf.int32, [None])
+            self.target_rank = target_rank_op(self.output2, self.eval_targets)
 
             # TRFL way
             self.actions = tf.placeholder(tf.int32, [None])
-            self.targetQs_ = tf.placeholder(tf.float32, [None, item_num])
+            # [None, item_num], or [None, num_candidates] with --candidate_targets
+            self.targetQs_ = tf.placeholder(tf.float32, [None, None])
             self.targetQs_selector = tf.placeholder(tf.float32, [None,
-                                                                 item_num])  # used for select best action for double q learning
+                                                                 None])  # used for select best action for double q learning
             self.reward = tf.placeholder(tf.float32, [None])
             self.discount = tf.placeholder(tf.float32, [None])
 
@@ -119,14 +153,26 @@ class NextItNet:
             self.q_max = tf.math.reduce_max(q_indexed)
 
             celoss = tf.multiply(q_indexed, naive_celoss)
-            self.loss_ac = tf.reduce_mean(qloss + celoss + args.CQL_weight * CQL_loss)
-            self.loss_th = tf.reduce_mean(qloss + naive_celoss + args.CQL_weight * CQL_loss)
             self.q_loss = tf.reduce_mean(qloss)
             self.ce_loss = tf.reduce_mean(celoss)
             self.naive_celoss = tf.reduce_mean(naive_celoss)
             self.CQL_loss = CQL_loss
-            self.opt_ac = tf.train.AdamOptimizer(learning_rate).minimize(self.loss_ac)
-            self.opt_th = tf.train.AdamOptimizer(learning_rate).minimize(self.loss_th)
+            # one optimizer for both phases, the warm-up loss is picked in-graph; each loss is
+            # built in its own branch, so only the picked one is computed and differentiated
+            def _warmup_loss():
+                return tf.reduce_mean(qloss + naive_celoss + args.CQL_weight * CQL_loss)
+
+            def _main_loss():
+                return tf.reduce_mean(qloss + celoss + args.CQL_weight * CQL_loss)
+
+            self.warmup = tf.placeholder_with_default(False, shape=(), name='warmup')
+            self.loss = tf.cond(self.warmup, _warmup_loss, _main_loss)
+            if trainable:
+                # a frozen target copy gets no optimizer and no Adam slots; its variables stay in
+                # TRAINABLE_VARIABLES, where target_update_op and the offline evaluator find them,
+                # so every update is restricted to the variables of this network
+                self.opt = tf.train.AdamOptimizer(learning_rate).minimize(
+                    self.loss, var_list=tf.trainable_variables(self.name + '/'))
 
     def initialize_embeddings(self):
         all_embeddings = dict()
@@ -136,61 +182,30 @@ class NextItNet:
         return all_embeddings
 
 def evaluate(sess):
-    eval_sessions=pd.read_pickle(os.path.join(data_directory, 'sampled_test.df'))
-    eval_ids = eval_sessions.session_id.unique()
-    groups = eval_sessions.groupby('session_id')
-    batch = 100
+    session_offsets = eval_data['session_offsets']
+    num_sessions = len(session_offsets) - 1
+    batch = args.eval_batch
     evaluated=0
-    total_clicks=0.0
-    total_purchase = 0.0
+    total_clicks = float(np.sum(eval_data['is_buy'] != 1))
+    total_purchase = float(np.sum(eval_data['is_buy'] == 1))
     total_reward = [0, 0, 0, 0]
     hit_clicks=[0,0,0,0]
     ndcg_clicks=[0,0,0,0]
     hit_purchase=[0,0,0,0]
     ndcg_purchase=[0,0,0,0]
-    while evaluated<len(eval_ids):
-        states, len_states, actions, rewards = [], [], [], []
-        for i in range(batch):
-            if evaluated==len(eval_ids):
-                break
-            id=eval_ids[evaluated]
-            group=groups.get_group(id)
-            history=[]
-            for index, row in group.iterrows():
-                state=list(history)
-                len_states.append(state_size 
-                        if len(state)>=state_size else 1 if len(state)==0 else len(state))
-                state=pad_history(state,state_size,item_num)
-                states.append(state)
-                action=row['item_id']
-                is_buy=row['is_buy']
-                reward = reward_buy if is_buy == 1 else reward_click
-                if is_buy==1:
-                    total_purchase+=1.0
-                else:
-                    total_clicks+=1.0
-                actions.append(action)
-                rewards.append(reward)
-                history.append(row['item_id'])
-            evaluated+=1
-
-        prediction=sess.run(NextRec1.output2, 
-            feed_dict={NextRec1.inputs: states,NextRec1.len_state:len_states,NextRec1.is_training:False})
+    while evaluated<num_sessions:
+        # each batch is a slice of `batch` whole sessions of the compiled test set
+        begin = session_offsets[evaluated]
+        evaluated = min(evaluated + batch, num_sessions)
+        end = session_offsets[evaluated]
+        states = eval_data['states'][begin:end]
+        len_states = eval_data['len_states'][begin:end]
+        actions = eval_data['actions'][begin:end]
+        rewards = np.where(eval_data['is_buy'][begin:end] == 1, reward_buy, reward_click)
 
-        n_jobs = len(prediction) // 36 + 1
-        if n_jobs > 4:
-            n_jobs = 4
-
-        res = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(np.argsort)(part) for part in np.array_split(prediction, n_jobs))
-        FirstIter = True
-        sorted_list = None
-        for part in res:
-            if FirstIter:
-                sorted_list = np.copy(part)
-                FirstIter = False
-            else:
-                sorted_list = np.concatenate([sorted_list, part])
-        calculate_hit(sorted_list,topk,actions,rewards,reward_click,total_reward,
+        ranks=sess.run(NextRec1.target_rank, 
+            feed_dict={NextRec1.inputs: states,NextRec1.len_state:len_states,NextRec1.is_training:False,NextRec1.eval_targets:actions})
+        calculate_rank_hit(ranks,topk,rewards,reward_click,total_reward,
                         hit_clicks,ndcg_clicks,hit_purchase,ndcg_purchase)
     best_rec = [[0,0,0,0,0], [0,0,0,0,0], [0,0,0,0,0], [0,0,0,0,0]]
     for i in range(len(topk)):
@@ -224,6 +239,7 @@ if __name__ == '__main__':
     reward_click = args.r_click
     reward_buy = args.r_buy
     topk=[5,10,15,20]
+    eval_data = compile_eval_data(data_directory, state_size, item_num)
     # save_file = 'pretrain-GRU/%d' % (hidden_size)
 
     tf.reset_default_graph()
@@ -234,9 +250,15 @@ if __name__ == '__main__':
     NextRec2 = NextItNet(hidden_size=args.hidden_factor, learning_rate=args.lr, 
                         item_num=item_num,state_size=state_size,
                         num_multi_head=args.num_multi_head,
-                        name='NextRec2')
+                        name='NextRec2', trainable=args.target_sync == 'double')
+
+    if args.target_sync != 'double':
+        # NextRec1 is the only trained network, NextRec2 its periodically synced target copy
+        target_copy_op = target_update_op(NextRec1.name, NextRec2.name)
+        target_polyak_op = target_update_op(NextRec1.name, NextRec2.name, args.tau)
 
     replay_buffer = pd.read_pickle(os.path.join(data_directory, 'replay_buffer.df'))
+    candidate_sampler = CandidateSampler(replay_buffer, item_num, args.num_popular, args.num_negatives)
     total_step=0
 
     log_data = []
@@ -252,18 +274,31 @@ if __name__ == '__main__':
     with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
         # Initialize variables
         sess.run(tf.global_variables_initializer())
+        checkpointer = Checkpointer(sess, os.path.join(args.checkpoint_dir, args.out), args.checkpoint_every)
+        if args.resume:
+            total_step = checkpointer.restore(log_data=log_data, total_score_rec=total_score_rec,
+                                              q_mean_log=q_mean_log, q_std_log=q_std_log)
         # evaluate(sess)
         num_rows=replay_buffer.shape[0]
         num_batches=int(num_rows/args.batch_size)
         print('epoch = {}    num_batches = {}'.format(args.epoch, num_batches))
         for i in range(args.epoch):
             for j in range(num_batches):
+                if i * num_batches + j < total_step:
+                    continue  # already trained before resuming
+                if args.target_sync == 'hard' and total_step % args.sync_every == 0 or \
+                        args.target_sync == 'polyak' and total_step == 0:
+                    sess.run(target_copy_op)
+                elif args.target_sync == 'polyak':
+                    sess.run(target_polyak_op)
+                checkpointer.maybe_save(total_step, log_data=log_data, total_score_rec=total_score_rec,
+                                        q_mean_log=q_mean_log, q_std_log=q_std_log)
                 # batch = entropy_correct_replay(replay_buffer)
                 batch = replay_buffer.sample(n=args.batch_size).to_dict()
                 next_state = list(batch['next_state'].values())
                 len_next_state = list(batch['len_next_states'].values())
                 # double q learning, pointer is for selecting which network  is target and which is main
-                pointer = np.random.randint(0, 2)
+                pointer = np.random.randint(0, 2) if args.target_sync == 'double' else 0
                 if pointer == 0:
                     mainQN = NextRec1
                     target_QN = NextRec2
@@ -273,23 +308,41 @@ if __name__ == '__main__':
 
                 random_coef = make_coeff(args.num_multi_head)
                 unifor_coef = [1/args.num_multi_head for _ in range(args.num_multi_head)]
-                target_Qs = sess.run(target_QN.output1,
-                                     feed_dict={target_QN.inputs: next_state,
-                                                target_QN.len_state: len_next_state,
-                                                target_QN.rco: random_coef,
-                                                target_QN.is_training: True,
-                                                target_QN.add_penalty: True})
-                target_Qs_selector = sess.run(mainQN.output1,
-                                              feed_dict={mainQN.inputs: next_state,
-                                                         mainQN.len_state: len_next_state,
-                                                         mainQN.rco: unifor_coef,
-                                                         mainQN.is_training: True,
-                                                         mainQN.add_penalty: True})
+                if args.candidate_targets:
+                    # bootstrap over the batch's candidate items instead of the whole item space
+                    candidates = candidate_sampler.sample(list(batch['action'].values()))
+                    target_Qs = sess.run(target_QN.output1_candidates,
+                                         feed_dict={target_QN.inputs: next_state,
+                                                    target_QN.len_state: len_next_state,
+                                                    target_QN.rco: random_coef,
+                                                    target_QN.is_training: True,
+                                                    target_QN.add_penalty: True,
+                                                    target_QN.candidates: candidates})
+                    target_Qs_selector = sess.run(mainQN.output1_candidates,
+                                                  feed_dict={mainQN.inputs: next_state,
+                                                             mainQN.len_state: len_next_state,
+                                                             mainQN.rco: unifor_coef,
+                                                             mainQN.is_training: True,
+                                                             mainQN.add_penalty: True,
+                                                             mainQN.candidates: candidates})
+                else:
+                    target_Qs = sess.run(target_QN.output1,
+                                         feed_dict={target_QN.inputs: next_state,
+                                                    target_QN.len_state: len_next_state,
+                                                    target_QN.rco: random_coef,
+                                                    target_QN.is_training: True,
+                                                    target_QN.add_penalty: True})
+                    target_Qs_selector = sess.run(mainQN.output1,
+                                                  feed_dict={mainQN.inputs: next_state,
+                                                             mainQN.len_state: len_next_state,
+                                                             mainQN.rco: unifor_coef,
+                                                             mainQN.is_training: True,
+                                                             mainQN.add_penalty: True})
                 # Set target_Qs to 0 for states where episode ends
                 is_done = list(batch['is_done'].values())
                 for index in range(target_Qs.shape[0]):
                     if is_done[index]:
-                        target_Qs[index] = np.zeros([item_num])
+                        target_Qs[index] = np.zeros([target_Qs.shape[1]])
 
                 state = list(batch['state'].values())
                 len_state = list(batch['len_state'].values())
@@ -301,7 +354,7 @@ if __name__ == '__main__':
                 discount = [args.discount] * len(action)
                 if total_step > 2000 * 5:
                     loss, _, qloss, celoss, naive_celoss, CQL_loss, q_mean, q_std, q_max = sess.run([
-                                        mainQN.loss_ac, mainQN.opt_ac, mainQN.q_loss, 
+                                        mainQN.loss, mainQN.opt, mainQN.q_loss, 
                                         mainQN.ce_loss, mainQN.naive_celoss, mainQN.CQL_loss,
                                         mainQN.q_mean, mainQN.q_std, mainQN.q_max],
                                     feed_dict={mainQN.inputs: state,
@@ -316,7 +369,7 @@ if __name__ == '__main__':
                                                 mainQN.add_penalty: False})
                 else:
                     loss, _, qloss, celoss, naive_celoss, CQL_loss, q_mean, q_std, q_max = sess.run([
-                                        mainQN.loss_th, mainQN.opt_th, mainQN.q_loss, 
+                                        mainQN.loss, mainQN.opt, mainQN.q_loss, 
                                         mainQN.ce_loss, mainQN.naive_celoss, mainQN.CQL_loss,
                                         mainQN.q_mean, mainQN.q_std, mainQN.q_max],
                                     feed_dict={mainQN.inputs: state,
@@ -328,7 +381,8 @@ if __name__ == '__main__':
                                                 mainQN.targetQs_selector: target_Qs_selector,
                                                 mainQN.rco: random_coef,
                                                 mainQN.is_training: True,
-                                                mainQN.add_penalty: False})
+                                                mainQN.add_penalty: False,
+                                                mainQN.warmup: True})
                 total_step += 1
                 if total_step % 100 == 0:
                     print("the naive_celoss is %.3f  weighted celoss is: %.3f  qloss is %.3f CQL_loss is %.3f" % 
@@ -349,6 +403,8 @@ if __name__ == '__main__':
                         total_score_rec.append(np.round(total_score, 3))
                         print('total score record', total_score_rec)
                         log_data.append(log_data_one_eval)
+        checkpointer.finish(total_step, log_data=log_data, total_score_rec=total_score_rec,
+                            q_mean_log=q_mean_log, q_std_log=q_std_log)
     print('time used in NextItNet AC CQL :', time.time() - start_time)
     log_data = pd.DataFrame(log_data, columns=column_name)
     log_data.to_csv('log_data_CQL/' + args.out + '.csv')
@@ -104,6 +104,19 @@ def embedding(inputs,
     else: return outputs
 
 
+def causal_bias(T_q, T_k, static_T_q=None, static_T_k=None):
+    '''Additive (T_q, T_k) mask hiding keys after each query.
+
+    The queries are the last T_q positions of the T_k keys. With static
+    lengths the mask is a constant built once with numpy.
+    '''
+    if static_T_q is not None and static_T_k is not None:
+        tril = np.tril(np.ones((static_T_q, static_T_k), dtype=np.float32), static_T_k - static_T_q)
+        return tf.constant((1.0 - tril) * (-2**32+1), dtype=tf.float32)
+    tril = tf.linalg.band_part(tf.ones([T_q, T_k]), -1, T_k - T_q)
+    return (1.0 - tril) * (-2**32+1)
+
+
 def multihead_attention(queries,
                         keys,
                         num_units=None, 
@@ -113,7 +126,8 @@ def multihead_attention(queries,
                         causality=False,
                         scope="multihead_attention", 
                         reuse=None,
-                        with_qk=False):
+                        with_qk=False,
+                        padding_mask=None):
     '''Applies multihead attention.
     
     Args:
@@ -127,6 +141,10 @@ def multihead_attention(queries,
       scope: Optional scope for `variable_scope`.
       reuse: Boolean, whether to reuse the weights of a previous layer
         by the same name.
+      padding_mask: Optional float tensor with shape of [N, T_k], 1 for items
+        and 0 for padding, e.g. from `inputs != item_num`. Used for the keys,
+        and for the queries when T_q == T_k. When None the masks are derived
+        from the embeddings, as zero vectors.
         
     Returns
       A 3d tensor with shape of (N, T_q, C)  
@@ -154,31 +172,29 @@ def multihead_attention(queries,
         # Scale
         outputs = outputs / (K_.get_shape().as_list()[-1] ** 0.5)
         
-        # Key Masking
-        key_masks = tf.sign(tf.abs(tf.reduce_sum(keys, axis=-1))) # (N, T_k)
-        key_masks = tf.tile(key_masks, [num_heads, 1]) # (h*N, T_k)
-        key_masks = tf.tile(tf.expand_dims(key_masks, 1), [1, tf.shape(queries)[1], 1]) # (h*N, T_q, T_k)
-        
-        paddings = tf.ones_like(outputs)*(-2**32+1)
-        outputs = tf.where(tf.equal(key_masks, 0), paddings, outputs) # (h*N, T_q, T_k)
-  
+        # Masking, as one additive bias broadcast over heads and queries
+        if padding_mask is None:
+            key_masks = tf.sign(tf.abs(tf.reduce_sum(keys, axis=-1))) # (N, T_k)
+            query_masks = tf.sign(tf.abs(tf.reduce_sum(queries, axis=-1))) # (N, T_q)
+        else:
+            key_masks = padding_mask
+            same_length = queries.get_shape()[1].value is not None and \
+                queries.get_shape()[1].value == keys.get_shape()[1].value
+            query_masks = padding_mask if same_length else None
+        bias = tf.expand_dims(tf.tile((1.0 - key_masks) * (-2**32+1), [num_heads, 1]), 1) # (h*N, 1, T_k)
+
         # Causality = Future blinding
         if causality:
-            diag_vals = tf.ones_like(outputs[0, :, :]) # (T_q, T_k)
-            tril = tf.linalg.LinearOperatorLowerTriangular(diag_vals).to_dense() # (T_q, T_k)
-            masks = tf.tile(tf.expand_dims(tril, 0), [tf.shape(outputs)[0], 1, 1]) # (h*N, T_q, T_k)
-   
-            paddings = tf.ones_like(masks)*(-2**32+1)
-            outputs = tf.where(tf.equal(masks, 0), paddings, outputs) # (h*N, T_q, T_k)
-  
+            bias += causal_bias(tf.shape(queries)[1], tf.shape(keys)[1],
+                                queries.get_shape()[1].value, keys.get_shape()[1].value) # (T_q, T_k)
+        outputs += bias # (h*N, T_q, T_k)
+
         # Activation
         outputs = tf.nn.softmax(outputs) # (h*N, T_q, T_k)
          
         # Query Masking
-        query_masks = tf.sign(tf.abs(tf.reduce_sum(queries, axis=-1))) # (N, T_q)
-        query_masks = tf.tile(query_masks, [num_heads, 1]) # (h*N, T_q)
-        query_masks = tf.tile(tf.expand_dims(query_masks, -1), [1, 1, tf.shape(keys)[1]]) # (h*N, T_q, T_k)
-        outputs *= query_masks # broadcasting. (N, T_q, C)
+        if query_masks is not None:
+            outputs *= tf.expand_dims(tf.tile(query_masks, [num_heads, 1]), -1) # broadcasting. (h*N, T_q, T_k)
           
         # Dropouts
         outputs = tf.layers.dropout(outputs, rate=dropout_rate, training=tf.convert_to_tensor(is_training))
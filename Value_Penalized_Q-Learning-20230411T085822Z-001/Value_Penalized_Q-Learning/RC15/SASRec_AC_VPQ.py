@@ -8,7 +8,6 @@ from utility import *
 from SASRecModules import *
 from trfl import indexing_ops
 import time 
-from joblib import Parallel,delayed
 import pickle
 
 
@@ -29,6 +28,8 @@ def parse_args():
                         help='reward for the purchase behavior.')
     parser.add_argument('--lr', type=float, default=0.005,
                         help='Learning rate.')
+    parser.add_argument('--eval_batch', type=int, default=100,
+                        help='Test sessions per evaluation batch.')
     parser.add_argument('--num_heads', default=1, type=int)
     parser.add_argument('--num_blocks', default=1, type=int)
     parser.add_argument('--discount', type=float, default=0.5,
@@ -39,12 +40,56 @@ def parse_args():
     parser.add_argument('--method', type=str, default='unspecified')
     parser.add_argument('--coef', type=int, default=10)
     parser.add_argument('--num_multi_head', type=int, default=15)
+    parser.add_argument('--candidate_targets', type=int, default=0,
+                        help='1: restrict the target argmax to a per-batch candidate set; 0: use all items.')
+    parser.add_argument('--num_popular', type=int, default=1000,
+                        help='Number of popular items in the target candidate set.')
+    parser.add_argument('--num_negatives', type=int, default=1000,
+                        help='Number of sampled items in the target candidate set.')
+    parser.add_argument('--target_sync', type=str, default='double',
+                        help='double: train both networks, picking the main one at random each step; '
+                             'hard: train one network and copy it to a frozen target every --sync_every steps; '
+                             'polyak: train one network and average it into the target every step with --tau.')
+    parser.add_argument('--sync_every', type=int, default=1000,
+                        help='Steps between target copies for --target_sync hard.')
+    parser.add_argument('--tau', type=float, default=0.005,
+                        help='Averaging rate for --target_sync polyak.')
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints',
+                        help='directory for the periodic checkpoints, one subdirectory per --out.')
+    parser.add_argument('--checkpoint_every', type=int, default=0,
+                        help='checkpoint every N training steps, 0 disables checkpointing.')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the latest checkpoint of this run.')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='data-parallel CPU worker processes, each training on its own shard of the replay buffer.')
+    parser.add_argument('--async_eval', action='store_true',
+                        help='evaluate weight snapshots in a background thread instead of pausing training.')
+    parser.add_argument('--eval_workers', type=int, default=1,
+                        help='worker processes for evaluation, each scoring a shard of the test sessions.')
+    parser.add_argument('--eval_negatives', type=int, default=0,
+                        help='rank each target against N popularity-weighted negatives in the evaluations during '
+                             'training and against all items only at the end, 0 always ranks against all items.')
+    parser.add_argument('--eval_q_head', choices=['off', 'penalized', 'plain'], default='off',
+                        help='also rank the Q-values (uniform head coefficients, with or without the '
+                             'uncertainty penalty) in the full evaluations and report them next to the CE head.')
+    parser.add_argument('--tie_embeddings', action='store_true',
+                        help='use the item embedding table as the kernel of the ce-logits, q-value and multi-head '
+                             'layers, with a projection per head.')
+    parser.add_argument('--lazy_adam', action='store_true',
+                        help='update only the embedding rows of the batch (LazyAdam) instead of the whole table; '
+                             'ignored with --num_workers > 1, whose allreduce densifies the gradients.')
+    parser.add_argument('--seq_train', action='store_true',
+                        help='train on windows of whole sessions, --batch_size windows per step, reading the states '
+                             'of all their transitions from one forward pass per network.')
+    parser.add_argument('--seq_stride', type=int, default=5,
+                        help='items a session window advances by with --seq_train, its transitions keep at least '
+                             'state_size - seq_stride items of history.')
     return parser.parse_args()
 
 
 class SASRecnetwork:
     def __init__(self, hidden_size,learning_rate,item_num,state_size, coef, num_multi_head,
-                name='SASRec', method='unspecified'):
+                name='SASRec', method='unspecified', trainable=True):
         self.state_size = state_size
         self.learning_rate = learning_rate
         self.hidden_size=hidden_size
@@ -88,7 +133,8 @@ class SASRecnetwork:
                                                    dropout_rate=args.dropout_rate,
                                                    is_training=self.is_training,
                                                    causality=True,
-                                                   scope="self_attention")
+                                                   scope="self_attention",
+                                                   padding_mask=mask[:, :, 0])
 
                     # Feed forward
                     self.seq = feedforward(normalize(self.seq), num_units=[self.hidden_size, self.hidden_size],
@@ -97,43 +143,68 @@ class SASRecnetwork:
                     self.seq *= mask
 
             self.seq = normalize(self.seq)
-            self.state_hidden=extract_axis_1(self.seq, self.len_state - 1)
+            # the last item of every input, or with --seq_train the positions of all the transitions of the windows
+            self.positions = state_positions(self.inputs, self.len_state)
+            self.state_hidden = gather_positions(self.seq, self.positions)
             # RL
-            multi_head_output = tf.contrib.layers.fully_connected(self.state_hidden, 
-                                    self.item_num * self.num_multi_head, 
-                                    activation_fn=None, scope='multi-head')
+            # the item-sized output layers share the state_embeddings table with --tie_embeddings
+            tied_embeddings = self.all_embeddings['state_embeddings'] if args.tie_embeddings else None
+            multi_head_output = output_layer(self.state_hidden, self.item_num, 'multi-head', self.num_multi_head,
+                                             tied_embeddings)
             multi_head_output = tf.reshape(multi_head_output, (tf.shape(multi_head_output)[0], 
                                                             self.item_num, self.num_multi_head))
-            out_rem = multi_head_output * tf.reshape(self.rco, [1,1,-1])
-
-            def _add_penalty_true_fn_rem():
-                if coef != 0:
-                    std = tf.math.reduce_std(multi_head_output, axis=-1)
-                    w = 1 / (1 + std * args.coef)
-                    return tf.math.reduce_sum(out_rem, axis=-1) * w 
-                else:
-                    return tf.math.reduce_sum(out_rem, axis=-1)
-            def _add_penalty_false_fn_rem():
-                return tf.math.reduce_sum(out_rem, axis=-1) 
 
+            def _rem_output(multi_head_output):
+                out_rem = multi_head_output * tf.reshape(self.rco, [1,1,-1])
+
+                def _add_penalty_true_fn_rem():
+                    if coef != 0:
+                        std = tf.math.reduce_std(multi_head_output, axis=-1)
+                        w = 1 / (1 + std * args.coef)
+                        return tf.math.reduce_sum(out_rem, axis=-1) * w 
+                    else:
+                        return tf.math.reduce_sum(out_rem, axis=-1)
+                def _add_penalty_false_fn_rem():
+                    return tf.math.reduce_sum(out_rem, axis=-1) 
+
+                return tf.cond(pred=tf.equal(self.add_penalty, self.flag), 
+                               true_fn=_add_penalty_true_fn_rem,
+                               false_fn=_add_penalty_false_fn_rem)
+
+            # Q-values of the candidate items only, for the bootstrap targets
+            self.candidates = tf.placeholder(tf.int32, [None], name='candidates')
             if method == 'baseline':
-                self.output1 = tf.contrib.layers.fully_connected(self.state_hidden, self.item_num,
-                                                             activation_fn=None, scope="q-value")
-            elif method == 'mean':
-                self.output1 = tf.math.reduce_mean(multi_head_output, axis=-1)
-            elif method =='rem':
-                self.output1 = tf.cond(pred=tf.equal(self.add_penalty, self.flag), 
-                                        true_fn=_add_penalty_true_fn_rem,
-                                        false_fn=_add_penalty_false_fn_rem)
-
-            self.output2 = tf.contrib.layers.fully_connected(self.state_hidden, self.item_num,
-                                                             activation_fn=None, scope="ce-logits")  # all logits
+                self.output1 = output_layer(self.state_hidden, self.item_num, "q-value", tied_embeddings=tied_embeddings)
+                self.output1_candidates = gather_fc_columns(self.state_hidden, "q-value", self.candidates)
+            else:
+                cand_multi_head_output = candidate_multi_head_output(self.state_hidden, self.candidates,
+                                                                     self.num_multi_head)
+                if method == 'mean':
+                    self.output1 = tf.math.reduce_mean(multi_head_output, axis=-1)
+                    self.output1_candidates = tf.math.reduce_mean(cand_multi_head_output, axis=-1)
+                elif method =='rem':
+                    self.output1 = _rem_output(multi_head_output)
+                    self.output1_candidates = _rem_output(cand_multi_head_output)
+
+            self.output2 = output_layer(self.state_hidden, self.item_num, "ce-logits",
+                                        tied_embeddings=tied_embeddings)  # all logits
+            # rank of the target item among all logits, so evaluation fetches only [batch] ints
+            self.eval_targets = tf.placeholder(tf.int32, [None])
+            self.target_rank = target_rank_op(self.output2, self.eval_targets)
+            self.eval_negatives = tf.placeholder(tf.int32, [None, None])
+            self.sampled_rank = sampled_rank_op(self.state_hidden, "ce-logits", self.eval_targets, self.eval_negatives)
+            # best items of every state, for the coverage and popularity metrics
+            self.top_items = tf.nn.top_k(self.output2, k=max(topk)).indices
+            # the same for the Q-values, fed with the evaluation rco and add_penalty
+            self.q_target_rank = target_rank_op(self.output1, self.eval_targets)
+            self.q_top_items = tf.nn.top_k(self.output1, k=max(topk)).indices
 
             # TRFL way
             self.actions = tf.placeholder(tf.int32, [None])
-            self.targetQs_ = tf.placeholder(tf.float32, [None, item_num])
+            # [None, item_num], or [None, num_candidates] with --candidate_targets
+            self.targetQs_ = tf.placeholder(tf.float32, [None, None])
             self.targetQs_selector = tf.placeholder(tf.float32, [None,
-                                                                 item_num])  # used for select best action for double q learning
+                                                                 None])  # used for select best action for double q learning
             self.reward = tf.placeholder(tf.float32, [None])
             self.discount = tf.placeholder(tf.float32, [None])
 
@@ -142,14 +213,29 @@ class SASRecnetwork:
                                                       self.targetQs_, self.targetQs_selector)
             q_indexed = tf.stop_gradient(indexing_ops.batched_index(self.output1, self.actions))
 
-            celoss1 = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.actions, logits=self.output2)
-            celoss2 = tf.multiply(q_indexed, tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.actions,
-                                                                                           logits=self.output2))
-
-            self.loss1 = tf.reduce_mean(celoss1+qloss)
-            self.loss2 =tf.reduce_mean(celoss2+qloss)
-            self.opt1 = tf.train.AdamOptimizer(learning_rate).minimize(self.loss1)
-            self.opt2 = tf.train.AdamOptimizer(learning_rate).minimize(self.loss2)
+            celoss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.actions, logits=self.output2)
+
+            # one optimizer for both phases, the warm-up loss is picked in-graph; each loss is
+            # built in its own branch, so only the picked one is computed and differentiated
+            def _warmup_loss():
+                return tf.reduce_mean(celoss + qloss)
+
+            def _main_loss():
+                return tf.reduce_mean(tf.multiply(q_indexed, celoss) + qloss)
+
+            self.warmup = tf.placeholder_with_default(False, shape=(), name='warmup')
+            self.loss = tf.cond(self.warmup, _warmup_loss, _main_loss)
+            if trainable:
+                # a frozen target copy gets no optimizer and no Adam slots; its variables stay in
+                # TRAINABLE_VARIABLES, where target_update_op and the offline evaluator find them,
+                # so every update is restricted to the variables of this network
+                optimizer = tf.train.AdamOptimizer(learning_rate)
+                if allreduce is not None:
+                    self.opt = allreduce_minimize(optimizer, self.loss, self.name, allreduce)
+                elif args.lazy_adam:
+                    self.opt = lazy_adam_minimize(learning_rate, self.loss, self.name)
+                else:
+                    self.opt = optimizer.minimize(self.loss, var_list=tf.trainable_variables(self.name + '/'))
             
 
 
@@ -163,78 +249,26 @@ class SASRecnetwork:
         all_embeddings['pos_embeddings']=pos_embeddings
         return all_embeddings
 
-def evaluate(sess):
-    eval_sessions=pd.read_pickle(os.path.join(data_directory, 'sampled_test.df'))
-    eval_ids = eval_sessions.session_id.unique()
-    groups = eval_sessions.groupby('session_id')
-    batch = 100
-    evaluated=0
-    total_clicks=0.0
-    total_purchase = 0.0
-    total_reward = [0, 0, 0, 0]
-    hit_clicks=[0,0,0,0]
-    ndcg_clicks=[0,0,0,0]
-    hit_purchase=[0,0,0,0]
-    ndcg_purchase=[0,0,0,0]
-    while evaluated<len(eval_ids):
-        states, len_states, actions, rewards = [], [], [], []
-        for i in range(batch):
-            if evaluated==len(eval_ids):
-                break
-            id=eval_ids[evaluated]
-            group=groups.get_group(id)
-            history=[]
-            for index, row in group.iterrows():
-                state=list(history)
-                len_states.append(state_size if len(state)>=state_size else 1 if len(state)==0 else len(state))
-                state=pad_history(state,state_size,item_num)
-                states.append(state)
-                action=row['item_id']
-                is_buy=row['is_buy']
-                reward = reward_buy if is_buy == 1 else reward_click
-                if is_buy==1:
-                    total_purchase+=1.0
-                else:
-                    total_clicks+=1.0
-                actions.append(action)
-                rewards.append(reward)
-                history.append(row['item_id'])
-            evaluated+=1
-
-        prediction=sess.run(SASRec1.output2, feed_dict={SASRec1.inputs: states,SASRec1.len_state:len_states,SASRec1.is_training:False})
-        # Parallel
-        n_jobs = len(prediction) // 36 + 1
-        if n_jobs > 12:
-            n_jobs = 12
-
-        res = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(np.argsort)(part) for part in np.array_split(prediction, n_jobs))
-        FirstIter = True
-        sorted_list = None
-        for part in res:
-            if FirstIter:
-                sorted_list = np.copy(part)
-                FirstIter = False
-            else:
-                sorted_list = np.concatenate([sorted_list, part])
-        calculate_hit(sorted_list,topk,actions,rewards,reward_click,total_reward,hit_clicks,ndcg_clicks,hit_purchase,ndcg_purchase)
-
-    best_rec = [[0,0,0,0,0], [0,0,0,0,0], [0,0,0,0,0], [0,0,0,0,0]]
-    for i in range(len(topk)):
-        hr_click=hit_clicks[i]/total_clicks
-        hr_purchase=hit_purchase[i]/total_purchase
-        ng_click=ndcg_clicks[i]/total_clicks
-        ng_purchase=ndcg_purchase[i]/total_purchase
-        print('\t\t'* (topk[i] // 5) + 'reward  @%d : %f' % (topk[i],total_reward[i]))
-        print('\t\t'* (topk[i] // 5) + 'c hr ng @%d : %f, %f' % (topk[i],hr_click,ng_click))
-        print('\t\t'* (topk[i] // 5) + 'p hr ng @%d : %f, %f' % (topk[i], hr_purchase, ng_purchase))
-
-        best_rec[i][0] = total_reward[i]
-        best_rec[i][1] = hr_click
-        best_rec[i][2] = float(ng_click)
-        best_rec[i][3] = hr_purchase
-        best_rec[i][4] = float(ng_purchase)
-
-    return np.array(best_rec).reshape(1, -1)[0]
+def evaluate(sess, sampled=False, network=None):
+    network = SASRec1 if network is None else network
+    q_head = None if args.eval_q_head == 'off' or sampled else args.eval_q_head == 'penalized'
+    if sharded_evaluator is not None:
+        accumulators = sharded_evaluator.evaluate(scope_weights(sess, network.name), sampled, q_head)
+    else:
+        accumulators = evaluate_network(sess, network, eval_data, topk, reward_click, reward_buy, args.eval_batch,
+                                        sampled=sampled, q_head=q_head)
+    return head_results(accumulators, args.eval_q_head != 'off')
+
+def record_eval(step, log_data_one_eval, mode):
+    # the score only sums the reward/HR/NDCG block, not the extended metrics
+    main_metrics = log_data_one_eval[:5 * len(topk)]
+    total_score = main_metrics[main_metrics<1].sum()
+    print('total socre ', total_score)
+    total_score_rec.append(np.round(total_score, 3))
+    print('total score rec ', pd.DataFrame(total_score_rec))
+    log_data.append(log_data_one_eval)
+    eval_steps.append(step)
+    eval_modes.append(mode)
 
 if __name__ == '__main__':
     start_time = time.time()
@@ -242,6 +276,8 @@ if __name__ == '__main__':
     args = parse_args()
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
     tf.reset_default_graph()
+    # the barrier has to exist before the workers are forked
+    allreduce = SharedMemoryAllreduce(args.num_workers) if args.num_workers > 1 else None
 
 
     data_directory = args.data
@@ -252,6 +288,13 @@ if __name__ == '__main__':
     reward_click = args.r_click
     reward_buy = args.r_buy
     topk=[5,10,15,20]
+    eval_data = compile_eval_data(data_directory, state_size, item_num)
+    sampled_eval = args.eval_negatives > 0
+    eval_mode = 'sampled' if sampled_eval else 'full'
+    if sampled_eval:
+        eval_data['negatives'] = compile_eval_negatives(data_directory, eval_data, item_num, args.eval_negatives)
+    eval_data['popularity'] = item_popularity(data_directory, item_num)
+    eval_data['length_bucket'] = np.digitize(eval_data['len_states'], LENGTH_BUCKET_EDGES)
 
     SASRec1 = SASRecnetwork(hidden_size=args.hidden_factor, learning_rate=args.lr,
                             item_num=item_num,state_size=state_size, coef=args.coef,
@@ -260,33 +303,118 @@ if __name__ == '__main__':
     SASRec2 = SASRecnetwork(hidden_size=args.hidden_factor, learning_rate=args.lr, 
                             item_num=item_num, state_size=state_size, coef=args.coef,
                             num_multi_head=args.num_multi_head, 
-                            name='SASRec2', method=args.method)
+                            name='SASRec2', trainable=args.target_sync == 'double', method=args.method)
+
+    async_evaluator = None
+    if args.async_eval:
+        # frozen copy of SASRec1, scored in the background while training continues
+        SASRec_eval = SASRecnetwork(hidden_size=args.hidden_factor, learning_rate=args.lr, 
+                                    item_num=item_num, state_size=state_size, coef=args.coef,
+                                    num_multi_head=args.num_multi_head, 
+                                    name='SASRec_eval', trainable=False, method=args.method)
+        eval_snapshot_op = target_update_op(SASRec1.name, SASRec_eval.name)
+
+    if args.target_sync != 'double':
+        # SASRec1 is the only trained network, SASRec2 its periodically synced target copy
+        target_copy_op = target_update_op(SASRec1.name, SASRec2.name)
+        target_polyak_op = target_update_op(SASRec1.name, SASRec2.name, args.tau)
 
     replay_buffer = pd.read_pickle(os.path.join(data_directory, 'replay_buffer.df'))
+    candidate_sampler = CandidateSampler(replay_buffer, item_num, args.num_popular, args.num_negatives)
+    session_windows = None
+    if args.seq_train:
+        # built from the whole buffer, the sessions are contiguous in it
+        session_windows = SessionWindows(replay_buffer, state_size, item_num, args.seq_stride)
+    # the pointer and REM coefficients, drawn alike on every worker and apart from np.random,
+    # which the evaluation draws from on rank 0 only
+    sync_rng = np.random.RandomState(np.random.randint(2 ** 31 - 1))
+    shard_rng = None
+    if allreduce is not None:
+        # every worker trains on its own shard with its own sampling RNG
+        rank = allreduce.fork()
+        replay_buffer = replay_buffer.iloc[rank::args.num_workers]
+        if session_windows is not None:
+            session_windows.shard(rank, args.num_workers)
+        shard_rng = np.random.RandomState(rank)
 
     total_step=0
     log_data = []
     total_score_rec = []
+    eval_steps = []
+    eval_modes = []
     column_name = ['rew@5', 'hr_c@5', 'ng_c@5', 'hr_p@5', 'ng_p@5', 
 					'rew@10', 'hr_c@10', 'ng_c@10', 'hr_p@10', 'ng_p@10', 
 					'rew@15', 'hr_c@15', 'ng_c@15', 'hr_p@15', 'ng_p@15',
 					'rew@20', 'hr_c@20', 'ng_c@20', 'hr_p@20', 'ng_p@20']
+    column_name += extended_metric_names(topk)
+    if args.eval_q_head != 'off':
+        column_name += ['q_' + name for name in column_name]
+
+    sharded_evaluator = None
+    if args.eval_workers > 1 and (allreduce is None or allreduce.rank == 0):
+        # forked before any session exists, the workers get the weights at every evaluation
+        evaluate_shard = lambda sess, sampled, q_head, shard, num_shards: evaluate_network(
+            sess, SASRec1, eval_data, topk, reward_click, reward_buy, args.eval_batch, shard, num_shards, sampled,
+            q_head)
+        sharded_evaluator = ShardedEvaluator(args.eval_workers, SASRec1.name, evaluate_shard)
 
     gpu_options = tf.GPUOptions(allow_growth=True)
-    with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
+    config = tf.ConfigProto(gpu_options=gpu_options) if allreduce is None else allreduce.session_config(gpu_options)
+    with tf.Session(config=config) as sess:
         # Initialize variables
         sess.run(tf.global_variables_initializer())
+        checkpointer = Checkpointer(sess, os.path.join(args.checkpoint_dir, args.out), args.checkpoint_every,
+                                    rngs={'sync': sync_rng, 'shard': shard_rng}, allreduce=allreduce)
+        if args.resume:
+            total_step = checkpointer.restore(log_data=log_data, total_score_rec=total_score_rec,
+                                              eval_steps=eval_steps, eval_modes=eval_modes)
+        start_step = total_step
+        if allreduce is not None:
+            # every replica starts from the initialized or restored weights of rank 0
+            broadcast_variables(sess, allreduce)
+        if args.async_eval:
+            async_evaluator = AsyncEvaluator(
+                sess, eval_snapshot_op, lambda sess, *eval_args: evaluate(sess, *eval_args, network=SASRec_eval))
         # evaluate(sess)
-        num_rows=replay_buffer.shape[0]
+        num_rows=replay_buffer.shape[0] if session_windows is None else len(session_windows)
+        if allreduce is not None:
+            # the shards differ by up to one row, and every worker has to run the same number of steps
+            num_rows = int(allreduce.gather(num_rows).min())
         num_batches=int(num_rows/args.batch_size)
         print('epoch = {}    num_batches = {}'.format(args.epoch, num_batches))
         for i in range(args.epoch):
             for j in range(num_batches):
-                batch = replay_buffer.sample(n=args.batch_size).to_dict()
-                next_state = list(batch['next_state'].values())
-                len_next_state = list(batch['len_next_states'].values())
+                if i * num_batches + j < total_step:
+                    continue  # already trained before resuming
+                if allreduce is not None and (total_step == start_step + 1 or checkpointer.due(total_step)):
+                    # after the first update, and before every checkpoint so a drift is not saved
+                    check_replicas(sess, allreduce)
+                if args.target_sync == 'hard' and total_step % args.sync_every == 0 or \
+                        args.target_sync == 'polyak' and total_step == 0:
+                    sess.run(target_copy_op)
+                elif args.target_sync == 'polyak':
+                    sess.run(target_polyak_op)
+                if async_evaluator is not None:
+                    if checkpointer.due(total_step):
+                        # the checkpoint has to hold the evaluation still running in the background
+                        async_evaluator.wait()
+                    for step, log_data_one_eval in async_evaluator.drain():
+                        record_eval(step, log_data_one_eval, eval_mode)
+                checkpointer.maybe_save(total_step, log_data=log_data, total_score_rec=total_score_rec,
+                                        eval_steps=eval_steps, eval_modes=eval_modes)
+                if session_windows is not None:
+                    # every transition reads its state and next state from one pass over the windows
+                    batch = session_windows.sample(args.batch_size, shard_rng)
+                    state_feed = lambda QN: {QN.inputs: batch['inputs'], QN.positions: batch['positions']}
+                    next_state_feed = lambda QN: {QN.inputs: batch['inputs'], QN.positions: batch['next_positions']}
+                else:
+                    batch = replay_buffer.sample(n=args.batch_size, random_state=shard_rng).to_dict()
+                    batch = dict((key, list(column.values())) for key, column in batch.items())
+                    state_feed = lambda QN: {QN.inputs: batch['state'], QN.len_state: batch['len_state']}
+                    next_state_feed = lambda QN: {QN.inputs: batch['next_state'],
+                                                  QN.len_state: batch['len_next_states']}
                 # double q learning, pointer is for selecting which network  is target and which is main
-                pointer = np.random.randint(0, 2)
+                pointer = sync_rng.randint(0, 2) if args.target_sync == 'double' else 0
                 if pointer == 0:
                     mainQN = SASRec1
                     target_QN = SASRec2
@@ -294,31 +422,43 @@ if __name__ == '__main__':
                     mainQN = SASRec2
                     target_QN = SASRec1
 
-                random_coef = make_coeff(args.num_multi_head)
+                random_coef = make_coeff(args.num_multi_head, sync_rng)
                 unifor_coef = [1/args.num_multi_head for _ in range(args.num_multi_head)]
-                target_Qs = sess.run(target_QN.output1,
-                                     feed_dict={target_QN.inputs: next_state,
-                                                target_QN.len_state: len_next_state,
-                                                target_QN.rco: random_coef,
-                                                target_QN.is_training:True,
-                                                target_QN.add_penalty: True})
-                target_Qs_selector = sess.run(mainQN.output1,
-                                              feed_dict={mainQN.inputs: next_state,
-                                                         mainQN.len_state: len_next_state,
-                                                         mainQN.rco: unifor_coef,
-                                                         mainQN.is_training:True,
-                                                         mainQN.add_penalty: True})
+                if args.candidate_targets:
+                    # bootstrap over the batch's candidate items instead of the whole item space
+                    candidates = candidate_sampler.sample(batch['action'])
+                    target_Qs = sess.run(target_QN.output1_candidates,
+                                         feed_dict={**next_state_feed(target_QN),
+                                                    target_QN.rco: random_coef,
+                                                    target_QN.is_training:True,
+                                                    target_QN.add_penalty: True,
+                                                    target_QN.candidates: candidates})
+                    target_Qs_selector = sess.run(mainQN.output1_candidates,
+                                                  feed_dict={**next_state_feed(mainQN),
+                                                             mainQN.rco: unifor_coef,
+                                                             mainQN.is_training:True,
+                                                             mainQN.add_penalty: True,
+                                                             mainQN.candidates: candidates})
+                else:
+                    target_Qs = sess.run(target_QN.output1,
+                                         feed_dict={**next_state_feed(target_QN),
+                                                    target_QN.rco: random_coef,
+                                                    target_QN.is_training:True,
+                                                    target_QN.add_penalty: True})
+                    target_Qs_selector = sess.run(mainQN.output1,
+                                                  feed_dict={**next_state_feed(mainQN),
+                                                             mainQN.rco: unifor_coef,
+                                                             mainQN.is_training:True,
+                                                             mainQN.add_penalty: True})
 
                 # Set target_Qs to 0 for states where episode ends
-                is_done = list(batch['is_done'].values())
+                is_done = batch['is_done']
                 for index in range(target_Qs.shape[0]):
                     if is_done[index]:
-                        target_Qs[index] = np.zeros([item_num])
+                        target_Qs[index] = np.zeros([target_Qs.shape[1]])
 
-                state = list(batch['state'].values())
-                len_state = list(batch['len_state'].values())
-                action = list(batch['action'].values())
-                is_buy = list(batch['is_buy'].values())
+                action = batch['action']
+                is_buy = batch['is_buy']
                 reward = []
                 for k in range(len(is_buy)):
                     reward.append(reward_buy if is_buy[k] == 1 else reward_click)
@@ -326,9 +466,8 @@ if __name__ == '__main__':
 
                 if total_step<0:
 
-                    loss, _ = sess.run([mainQN.loss1, mainQN.opt1],
-                                       feed_dict={mainQN.inputs: state,
-                                                  mainQN.len_state: len_state,
+                    loss, _ = sess.run([mainQN.loss, mainQN.opt],
+                                       feed_dict={**state_feed(mainQN),
                                                   mainQN.targetQs_: target_Qs,
                                                   mainQN.reward: reward,
                                                   mainQN.discount: discount,
@@ -336,25 +475,23 @@ if __name__ == '__main__':
                                                   mainQN.targetQs_selector: target_Qs_selector,
                                                   mainQN.rco: random_coef,
                                                   mainQN.is_training:True,
-                                                  mainQN.add_penalty: False})
+                                                  mainQN.add_penalty: False,
+                                                  mainQN.warmup: True})
                     total_step += 1
                     # if total_step % 200 == 0:
                     #     print("the loss in %dth batch is: %f" % (total_step, loss))
-                    if total_step % 2000== 0:
+                    if total_step % 2000 == 0 and (allreduce is None or allreduce.rank == 0):
                         print('\nstart to eval')
                         time_eval_start = time.time()
-                        log_data_one_eval = evaluate(sess)
+                        if async_evaluator is not None:
+                            async_evaluator.submit(total_step, sampled_eval)
+                        else:
+                            record_eval(total_step, evaluate(sess, sampled_eval), eval_mode)
                         print('time used in one eval', time.time() - time_eval_start)
-                        total_score = log_data_one_eval[log_data_one_eval<1].sum()
-                        print('total socre ', total_score)
-                        total_score_rec.append(np.round(total_score, 3))
-                        print('total score rec ', pd.DataFrame(total_score_rec))
-                        log_data.append(log_data_one_eval)    
 
                 else:
-                    loss, _ = sess.run([mainQN.loss2, mainQN.opt2],
-                                       feed_dict={mainQN.inputs: state,
-                                                  mainQN.len_state: len_state,
+                    loss, _ = sess.run([mainQN.loss, mainQN.opt],
+                                       feed_dict={**state_feed(mainQN),
                                                   mainQN.targetQs_: target_Qs,
                                                   mainQN.reward: reward,
                                                   mainQN.discount: discount,
@@ -366,20 +503,33 @@ if __name__ == '__main__':
                     total_step += 1
                     if total_step % 200 == 0:
                         print("the loss in %dth batch is: %f" % (total_step, loss))
-                    if total_step % 2000 == 0:
+                    if total_step % 2000 == 0 and (allreduce is None or allreduce.rank == 0):
                         if total_step < 2000 * 50:
                             pass
                         else:
                             print('\nstart to eval')
                             time_eval_start = time.time()
-                            log_data_one_eval = evaluate(sess)
+                            if async_evaluator is not None:
+                                async_evaluator.submit(total_step, sampled_eval)
+                            else:
+                                record_eval(total_step, evaluate(sess, sampled_eval), eval_mode)
                             print('time used in one eval', time.time() - time_eval_start)
-                            total_score = log_data_one_eval[log_data_one_eval<1].sum()
-                            print('total socre ', total_score)
-                            total_score_rec.append(np.round(total_score, 3))
-                            print('total score rec ', total_score_rec)
-                            log_data.append(log_data_one_eval)     
-        log_data = pd.DataFrame(log_data, columns=column_name)
+        if async_evaluator is not None:
+            async_evaluator.wait()
+            for step, log_data_one_eval in async_evaluator.drain():
+                record_eval(step, log_data_one_eval, eval_mode)
+        if sampled_eval and (allreduce is None or allreduce.rank == 0):
+            # the final numbers rank against all items
+            record_eval(total_step, evaluate(sess), 'full')
+        # every worker takes part, and the checkpoint holds the final evaluation
+        checkpointer.finish(total_step, log_data=log_data, total_score_rec=total_score_rec,
+                            eval_steps=eval_steps, eval_modes=eval_modes)
+        if sharded_evaluator is not None:
+            sharded_evaluator.close()
+        if allreduce is not None:
+            allreduce.join()  # only rank 0 writes the logs
+        log_data = pd.DataFrame(log_data, columns=column_name, index=pd.Index(eval_steps, name='step'))
+        log_data['eval_mode'] = eval_modes
         log_data.to_csv('log_data/' + args.out + '.csv')
         print('time used in SASRec-AC-VPQ :', time.time() - start_time)
         print('write log done')
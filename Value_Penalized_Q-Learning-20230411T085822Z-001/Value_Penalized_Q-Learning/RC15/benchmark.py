@@ -0,0 +1,219 @@
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CPU micro-benchmarks of the backbone building blocks.")
+
+    parser.add_argument('--op', choices=['attention', 'dilated_conv', 'caser_conv', 'gru_stream'], default='attention',
+                        help='building block to benchmark.')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='Batch size.')
+    parser.add_argument('--state_size', type=int, default=10,
+                        help='Sequence length.')
+    parser.add_argument('--hidden_factor', type=int, default=64,
+                        help='Number of hidden factors.')
+    parser.add_argument('--num_heads', type=int, default=1,
+                        help='Attention heads.')
+    parser.add_argument('--num_blocks', type=int, default=1,
+                        help='Stacked blocks.')
+    parser.add_argument('--repeats', type=int, default=200,
+                        help='Timed runs per variant.')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='intra-op threads, 0 lets TensorFlow decide.')
+    parser.add_argument('--tie_embeddings', action='store_true',
+                        help='gru_stream: tie the q-value head to state_embeddings.')
+    return parser.parse_args()
+
+
+def timed(sess, fetch, feed_dict, repeats):
+    '''Mean wall time of sess.run(fetch) in milliseconds, after two warm-up runs.'''
+    for _ in range(2):
+        sess.run(fetch, feed_dict=feed_dict)
+    start = time.time()
+    for _ in range(repeats):
+        sess.run(fetch, feed_dict=feed_dict)
+    return (time.time() - start) / repeats * 1000
+
+
+def reference_attention(queries, keys, num_units, num_heads, causality, scope):
+    '''multihead_attention before the static masks: tiled embedding masks and tf.where paddings.'''
+    with tf.variable_scope(scope, reuse=True):
+        Q = tf.layers.dense(queries, num_units, activation=None)
+        K = tf.layers.dense(keys, num_units, activation=None)
+        V = tf.layers.dense(keys, num_units, activation=None)
+        Q_ = tf.concat(tf.split(Q, num_heads, axis=2), axis=0)
+        K_ = tf.concat(tf.split(K, num_heads, axis=2), axis=0)
+        V_ = tf.concat(tf.split(V, num_heads, axis=2), axis=0)
+        outputs = tf.matmul(Q_, tf.transpose(K_, [0, 2, 1]))
+        outputs = outputs / (K_.get_shape().as_list()[-1] ** 0.5)
+        key_masks = tf.sign(tf.abs(tf.reduce_sum(keys, axis=-1)))
+        key_masks = tf.tile(key_masks, [num_heads, 1])
+        key_masks = tf.tile(tf.expand_dims(key_masks, 1), [1, tf.shape(queries)[1], 1])
+        paddings = tf.ones_like(outputs)*(-2**32+1)
+        outputs = tf.where(tf.equal(key_masks, 0), paddings, outputs)
+        if causality:
+            diag_vals = tf.ones_like(outputs[0, :, :])
+            tril = tf.linalg.LinearOperatorLowerTriangular(diag_vals).to_dense()
+            masks = tf.tile(tf.expand_dims(tril, 0), [tf.shape(outputs)[0], 1, 1])
+            paddings = tf.ones_like(masks)*(-2**32+1)
+            outputs = tf.where(tf.equal(masks, 0), paddings, outputs)
+        outputs = tf.nn.softmax(outputs)
+        query_masks = tf.sign(tf.abs(tf.reduce_sum(queries, axis=-1)))
+        query_masks = tf.tile(query_masks, [num_heads, 1])
+        query_masks = tf.tile(tf.expand_dims(query_masks, -1), [1, 1, tf.shape(keys)[1]])
+        outputs *= query_masks
+        outputs = tf.matmul(outputs, V_)
+        outputs = tf.concat(tf.split(outputs, num_heads, axis=0), axis=2)
+        return outputs + queries
+
+
+def benchmark_attention(args):
+    from SASRecModules import multihead_attention
+
+    item_num = 1000
+    rng = np.random.RandomState(0)
+    lengths = rng.randint(1, args.state_size + 1, args.batch_size)
+    ids = rng.randint(0, item_num, (args.batch_size, args.state_size))
+    ids[np.arange(args.state_size)[None, :] >= lengths[:, None]] = item_num  # padded at the end, as in the replay buffer
+
+    inputs = tf.placeholder(tf.int32, [None, args.state_size])
+    embeddings = tf.Variable(tf.random_normal([item_num + 1, args.hidden_factor], 0.0, 0.01))
+    mask = tf.expand_dims(tf.to_float(tf.not_equal(inputs, item_num)), -1)
+    seq = tf.nn.embedding_lookup(embeddings, inputs) * mask
+
+    static_seq = reference_seq = seq
+    for i in range(args.num_blocks):
+        scope = "num_blocks_%d" % i
+        static_seq = multihead_attention(queries=static_seq, keys=static_seq, num_units=args.hidden_factor,
+                                         num_heads=args.num_heads, is_training=False, causality=True,
+                                         scope=scope, padding_mask=mask[:, :, 0]) * mask
+        reference_seq = reference_attention(reference_seq, reference_seq, args.hidden_factor, args.num_heads,
+                                            True, scope) * mask
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=args.threads)
+    with tf.Session(config=config) as sess:
+        sess.run(tf.global_variables_initializer())
+        feed_dict = {inputs: ids}
+        static_out, reference_out = sess.run([static_seq, reference_seq], feed_dict=feed_dict)
+        print('max abs difference : %g' % np.max(np.abs(static_out - reference_out)))
+        print('tiled masks  : %.3f ms' % timed(sess, reference_seq, feed_dict, args.repeats))
+        print('static masks : %.3f ms' % timed(sess, static_seq, feed_dict, args.repeats))
+
+
+def benchmark_dilated_conv(args):
+    '''The twelve causal convolutions of the NextItNet residual stack, once per conv1d implementation.'''
+    from NextItNetModules import nextitnet_residual_block
+
+    dilations = [1, 2, 1, 2, 1, 2]
+    inputs = tf.placeholder(tf.float32, [None, args.state_size, args.hidden_factor])
+    outputs = {}
+    for impl in ['atrous', 'native', 'im2col']:
+        # the same initializers with a fixed seed give every implementation the same weights
+        with tf.variable_scope(impl):
+            output = inputs
+            for layer_id, dilation in enumerate(dilations):
+                output = nextitnet_residual_block(output, dilation, layer_id, args.hidden_factor, 3,
+                                                  causal=True, train=False, conv_impl=impl)
+            outputs[impl] = output
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=args.threads)
+    with tf.Session(config=config) as sess:
+        sess.run(tf.global_variables_initializer())
+        feed_dict = {inputs: np.random.RandomState(0).randn(args.batch_size, args.state_size, args.hidden_factor)}
+        reference = sess.run(outputs['atrous'], feed_dict=feed_dict)
+        for impl in ['atrous', 'native', 'im2col']:
+            difference = np.max(np.abs(sess.run(outputs[impl], feed_dict=feed_dict) - reference))
+            print('%-6s : %.3f ms, max abs difference %g'
+                  % (impl, timed(sess, outputs[impl], feed_dict, args.repeats), difference))
+
+
+def benchmark_caser_conv(args):
+    '''Caser horizontal and vertical convolutions, one conv2d per filter size against the fused matmul.'''
+    from CaserModules import horizontal_conv, vertical_conv
+
+    filter_sizes = [2, 3, 4]
+    inputs = tf.placeholder(tf.float32, [None, args.state_size, args.hidden_factor])
+    with tf.variable_scope('per_width'):
+        per_width = tf.concat([horizontal_conv(inputs, filter_sizes, 16, args.state_size, args.hidden_factor, False),
+                               vertical_conv(inputs, args.state_size, args.hidden_factor, False)], 1)
+    per_width_vars = tf.global_variables()
+    with tf.variable_scope('fused'):
+        fused = tf.concat([horizontal_conv(inputs, filter_sizes, 16, args.state_size, args.hidden_factor, True),
+                           vertical_conv(inputs, args.state_size, args.hidden_factor, True)], 1)
+    fused_vars = tf.global_variables()[len(per_width_vars):]
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=args.threads)
+    with tf.Session(config=config) as sess:
+        sess.run(tf.global_variables_initializer())
+        for per_width_var, fused_var in zip(per_width_vars, fused_vars):
+            fused_var.load(sess.run(per_width_var), sess)
+        feed_dict = {inputs: np.random.RandomState(0).randn(args.batch_size, args.state_size, args.hidden_factor)}
+        per_width_out, fused_out = sess.run([per_width, fused], feed_dict=feed_dict)
+        print('max abs difference : %g' % np.max(np.abs(per_width_out - fused_out)))
+        print('per width : %.3f ms' % timed(sess, per_width, feed_dict, args.repeats))
+        print('fused     : %.3f ms' % timed(sess, fused, feed_dict, args.repeats))
+
+
+def benchmark_gru_stream(args):
+    '''GRUStreamer scores against output1 of the GRU_AC_VPQ QNetwork, click by click, on random weights.'''
+    from evaluate_checkpoints import load_trainer
+    from streaming import GRUStreamer
+    from utility import pad_history, scope_weights
+
+    item_num = 1000
+    trainer_argv = ['--method', 'baseline', '--hidden_factor', str(args.hidden_factor)]
+    if args.tie_embeddings:
+        trainer_argv.append('--tie_embeddings')
+    trainer, trainer_args = load_trainer('GRU_AC_VPQ', trainer_argv)
+    # the network class reads these globals of the trainer module
+    trainer.args = trainer_args
+    trainer.item_num = item_num
+    trainer.allreduce = None
+    trainer.topk = [5, 10, 15, 20]
+    network = trainer.QNetwork(hidden_size=args.hidden_factor, learning_rate=0.001, item_num=item_num,
+                               state_size=args.state_size, coef=0, pretrain=False, num_multi_head=1,
+                               name='QN_1', method='baseline', trainable=False)
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=args.threads)
+    with tf.Session(config=config) as sess:
+        sess.run(tf.global_variables_initializer())
+        streamer = GRUStreamer(scope_weights(sess, network.name), head='q-value')
+        items = np.random.RandomState(0).randint(item_num, size=(args.batch_size, args.state_size))
+        session_ids = list(range(args.batch_size))
+
+        def network_scores(length):
+            # the padded history of the first `length` clicks, the empty history is one padding item
+            states = [pad_history(list(row[:length]), args.state_size, item_num) for row in items]
+            return sess.run(network.output1, feed_dict={network.inputs: states,
+                                                        network.len_state: [max(length, 1)] * args.batch_size,
+                                                        network.is_training: False})
+
+        difference = np.max(np.abs(streamer.scores(session_ids) - network_scores(0)))
+        stream_time, network_time = 0.0, 0.0
+        for t in range(args.state_size):
+            start = time.time()
+            streamer.append(session_ids, items[:, t])
+            scores = streamer.scores(session_ids)
+            stream_time += time.time() - start
+            start = time.time()
+            reference = network_scores(t + 1)
+            network_time += time.time() - start
+            difference = max(difference, np.max(np.abs(scores - reference)))
+        print('max abs difference : %g' % difference)
+        print('streamer : %.3f ms per click' % (stream_time / args.state_size * 1000))
+        print('network  : %.3f ms per click' % (network_time / args.state_size * 1000))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.op == 'attention':
+        benchmark_attention(args)
+    elif args.op == 'dilated_conv':
+        benchmark_dilated_conv(args)
+    elif args.op == 'caser_conv':
+        benchmark_caser_conv(args)
+    elif args.op == 'gru_stream':
+        benchmark_gru_stream(args)
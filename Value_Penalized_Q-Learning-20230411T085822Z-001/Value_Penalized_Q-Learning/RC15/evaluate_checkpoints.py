@@ -0,0 +1,122 @@
+import os
+import sys
+import glob
+import argparse
+import importlib
+import inspect
+import multiprocessing
+import pickle
+import time
+import pandas as pd
+import tensorflow as tf
+from utility import *
+
+# trainer prefix -> network class of the trainer, scope of its first network
+BACKBONES = {'SASRec': ('SASRecnetwork', 'SASRec1'),
+             'GRU': ('QNetwork', 'QN_1'),
+             'Caser': ('Caser', 'CaserRec1'),
+             'NextItNet': ('NextItNet', 'NextRec1')}
+TOPK = [5, 10, 15, 20]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline evaluation of trainer checkpoints.",
+                                     epilog='Unknown arguments (--data, --hidden_factor, --eval_batch, ...) are '
+                                            'passed to the parser of the trainer and must match the training run.')
+
+    parser.add_argument('--trainer', type=str, required=True,
+                        help='trainer script the checkpoints were written by, e.g. SASRec_AC_VPQ.')
+    parser.add_argument('--checkpoint_dir', type=str, required=True,
+                        help='directory searched recursively for ckpt-*.pkl files.')
+    parser.add_argument('--network', type=str, default=None,
+                        help='scope of the evaluated network, the first network of the trainer by default.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='checkpoints scored in parallel, each worker gets its own session.')
+    parser.add_argument('--result', type=str, default='log_data/offline_eval.csv',
+                        help='consolidated metrics table, one row per checkpoint.')
+    return parser.parse_known_args()
+
+
+def load_trainer(trainer_name, trainer_argv):
+    '''Imports a trainer script and parses its arguments without running it.'''
+    sys.argv = [trainer_name + '.py'] + trainer_argv
+    trainer = importlib.import_module(trainer_name)
+    return trainer, trainer.parse_args()
+
+
+def _init_worker(trainer_name, trainer_argv, scope, threads):
+    global worker
+    trainer, args = load_trainer(trainer_name, trainer_argv)
+    data_statis = pd.read_pickle(os.path.join(args.data, 'data_statis.df'))
+    state_size = data_statis['state_size'][0]
+    item_num = data_statis['item_num'][0]
+    # the network classes read these globals of the trainer module
+    trainer.args = args
+    trainer.item_num = item_num
+    trainer.allreduce = None
+    trainer.topk = TOPK
+
+    network_class = getattr(trainer, BACKBONES[trainer_name.split('_')[0]][0])
+    candidates = dict(hidden_size=args.hidden_factor, learning_rate=args.lr, item_num=item_num,
+                      state_size=state_size, coef=getattr(args, 'coef', None), pretrain=False,
+                      num_multi_head=args.num_multi_head, method=getattr(args, 'method', 'unspecified'),
+                      name=scope, trainable=False)
+    parameters = inspect.signature(network_class.__init__).parameters
+    network = network_class(**dict((k, v) for k, v in candidates.items() if k in parameters))
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)
+    sess = tf.Session(config=config)
+    sess.run(tf.global_variables_initializer())
+    eval_data = compile_eval_data(args.data, state_size, item_num)
+    eval_data['popularity'] = item_popularity(args.data, item_num)
+    eval_data['length_bucket'] = np.digitize(eval_data['len_states'], LENGTH_BUCKET_EDGES)
+    worker = {'args': args, 'sess': sess, 'network': network,
+              'variables': [var for var in tf.trainable_variables() if var.name.startswith(scope + '/')],
+              'eval_data': eval_data}
+
+
+def _evaluate_checkpoint(path):
+    with open(path, 'rb') as f:
+        checkpoint = pickle.load(f)
+    for var in worker['variables']:
+        var.load(checkpoint['variables'][var.name], worker['sess'])
+    args = worker['args']
+    accumulator = evaluate_network(worker['sess'], worker['network'], worker['eval_data'], TOPK,
+                                   args.r_click, args.r_buy, args.eval_batch)
+    print('\n%s (step %d)' % (path, checkpoint['total_step']))
+    return path, checkpoint['total_step'], accumulator.result(extended=True)
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+    args, trainer_argv = parse_args()
+    scope = args.network or BACKBONES[args.trainer.split('_')[0]][1]
+    checkpoints = sorted(glob.glob(os.path.join(args.checkpoint_dir, '**', 'ckpt-*.pkl'), recursive=True))
+    print('%d checkpoints in %s' % (len(checkpoints), args.checkpoint_dir))
+
+    # compile the test set once here, the workers only read the cached arrays
+    trainer, trainer_args = load_trainer(args.trainer, trainer_argv)
+    data_statis = pd.read_pickle(os.path.join(trainer_args.data, 'data_statis.df'))
+    compile_eval_data(trainer_args.data, data_statis['state_size'][0], data_statis['item_num'][0])
+
+    threads = max(1, multiprocessing.cpu_count() // args.workers)
+    pool = multiprocessing.Pool(args.workers, initializer=_init_worker,
+                                initargs=(args.trainer, trainer_argv, scope, threads))
+    rows = []
+    for path, step, result in pool.imap_unordered(_evaluate_checkpoint, checkpoints):
+        rows.append([os.path.relpath(path, args.checkpoint_dir), step] + list(result))
+    pool.close()
+    pool.join()
+
+    column_name = ['checkpoint', 'step']
+    for k in TOPK:
+        column_name += ['rew@%d' % k, 'hr_c@%d' % k, 'ng_c@%d' % k, 'hr_p@%d' % k, 'ng_p@%d' % k]
+    column_name += extended_metric_names(TOPK)
+    result = pd.DataFrame(rows, columns=column_name)
+    # the checkpoints of each run in training order, ckpt-2000 before ckpt-10000
+    result['run'] = result['checkpoint'].map(os.path.dirname)
+    result = result.sort_values(['run', 'step']).drop(columns='run')
+    if os.path.dirname(args.result) and not os.path.exists(os.path.dirname(args.result)):
+        os.makedirs(os.path.dirname(args.result))
+    result.to_csv(args.result, index=False)
+    print('time used in offline evaluation :', time.time() - start_time)
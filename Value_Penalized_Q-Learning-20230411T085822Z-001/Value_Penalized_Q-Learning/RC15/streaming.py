@@ -0,0 +1,336 @@
+'''
+Incremental inference for online sessions.
+
+The trainers score a state by encoding the whole padded `state_size` history.
+A streamer holds the weights of a trained network as numpy arrays and keeps
+a small cache per session, so a new click only runs the network for that
+click. The weights come from `scope_weights(sess, network.name)` and are
+picked up by their name below the network scope.
+'''
+import re
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SessionCache(object):
+    '''Per-session inference state, evicting the least recently used session.'''
+    def __init__(self, max_sessions=100000):
+        self.max_sessions = max_sessions
+        self.entries = OrderedDict()
+
+    def get(self, session_id):
+        entry = self.entries.get(session_id)
+        if entry is not None:
+            self.entries.move_to_end(session_id)
+        return entry
+
+    def put(self, session_id, entry):
+        self.entries[session_id] = entry
+        self.entries.move_to_end(session_id)
+        while len(self.entries) > self.max_sessions:
+            self.entries.popitem(last=False)
+
+    def pop(self, session_id):
+        return self.entries.pop(session_id, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def _scoped(weights, prefix, suffix):
+    '''Values of the weights below `prefix` whose name ends with `suffix`, in creation order.'''
+    return [value for name, value in weights.items() if name.startswith(prefix) and name.endswith(suffix)]
+
+
+def _embeddings(weights):
+    '''The state_embeddings table, also below the network's inner scope (QN_1/QN_1/ of the GRU trainers).'''
+    return _scoped(weights, '/', '/state_embeddings:0')[0]
+
+
+def _output_layer(weights, head):
+    '''(kernel [hidden, item_num], biases) of a single-head output layer, tied to state_embeddings or not.'''
+    biases = weights['/%s/biases:0' % head]
+    if '/%s/weights:0' % head in weights:
+        return weights['/%s/weights:0' % head], biases
+    # utility.output_layer with tied_embeddings
+    kernel = _embeddings(weights)[:len(biases)].T
+    if '/%s/projection:0' % head in weights:
+        kernel = weights['/%s/projection:0' % head].dot(kernel)
+    return kernel, biases
+
+
+def _layer_norm(x, beta, gamma, epsilon=1e-8):
+    # utility.normalize
+    mean = x.mean(axis=-1, keepdims=True)
+    variance = x.var(axis=-1, keepdims=True)
+    return gamma * (x - mean) / ((variance + epsilon) ** .5) + beta
+
+
+class SASRecStreamer(object):
+    '''Incremental SASRecnetwork encoder with cached keys and values.
+
+    Attention is causal, so the block outputs of the earlier positions do not
+    change when an item is appended. Each session keeps the keys and values
+    of every block; `append` projects only the new position and attends with
+    its query over the cache, O(T) per event instead of O(T^2) for the
+    padded window. Up to `state_size` items the result equals state_hidden
+    of the full network in inference mode (no dropout). Longer sessions
+    evict the oldest position of every block and give the new item the last
+    position embedding, a sliding-window approximation of re-encoding the
+    last `state_size` items.
+    '''
+    def __init__(self, weights, num_heads, head='ce-logits', max_sessions=100000):
+        self.num_heads = num_heads
+        self.state_embeddings = _embeddings(weights)
+        self.pos_embeddings = weights['/pos_embeddings:0']
+        self.state_size = len(self.pos_embeddings)
+        self.blocks = []
+        i = 0
+        while any(name.startswith('/num_blocks_%d/' % i) for name in weights):
+            prefix = '/num_blocks_%d/' % i
+            attention_kernels = _scoped(weights, prefix + 'self_attention/', 'kernel:0')
+            attention_biases = _scoped(weights, prefix + 'self_attention/', 'bias:0')
+            conv_kernels = _scoped(weights, prefix + 'multihead_attention/', 'kernel:0')
+            conv_biases = _scoped(weights, prefix + 'multihead_attention/', 'bias:0')
+            # normalize creates beta, then gamma, as unnamed Variables
+            betas = _scoped(weights, prefix + 'ln', '/Variable:0')
+            gammas = _scoped(weights, prefix + 'ln', '/Variable_1:0')
+            self.blocks.append({
+                'query': (attention_kernels[0], attention_biases[0]),
+                'key': (attention_kernels[1], attention_biases[1]),
+                'value': (attention_kernels[2], attention_biases[2]),
+                'inner': (conv_kernels[0][0], conv_biases[0]),
+                'readout': (conv_kernels[1][0], conv_biases[1]),
+                'ln_attention': (betas[0], gammas[0]),
+                'ln_feedforward': (betas[1], gammas[1])})
+            i += 1
+        self.final_norm = (weights['/ln/Variable:0'], weights['/ln/Variable_1:0'])
+        # the padded empty history is masked to zeros before the final normalization
+        self.empty_state = _layer_norm(np.zeros(self.state_embeddings.shape[1]), *self.final_norm).astype(np.float32)
+        self.head = _output_layer(weights, head)
+        self.cache = SessionCache(max_sessions)
+
+    def _new_entry(self):
+        hidden_size = self.state_embeddings.shape[1]
+        shape = (len(self.blocks), self.state_size, hidden_size)
+        return {'keys': np.zeros(shape, dtype=np.float32), 'values': np.zeros(shape, dtype=np.float32),
+                'length': 0, 'state_hidden': None}
+
+    def _attend(self, query, keys, values):
+        # query [C], keys/values [t, C], split into heads along C
+        t, hidden_size = keys.shape
+        head_size = hidden_size // self.num_heads
+        q = query.reshape(self.num_heads, 1, head_size)
+        k = keys.reshape(t, self.num_heads, head_size).transpose(1, 2, 0)
+        v = values.reshape(t, self.num_heads, head_size).transpose(1, 0, 2)
+        scores = np.matmul(q, k) / (head_size ** 0.5)  # (h, 1, t)
+        scores = np.exp(scores - scores.max(axis=-1, keepdims=True))
+        scores /= scores.sum(axis=-1, keepdims=True)
+        return np.matmul(scores, v).reshape(hidden_size)
+
+    def append(self, session_id, item):
+        '''Adds the clicked `item` to the session and returns its new state_hidden.'''
+        entry = self.cache.get(session_id)
+        if entry is None:
+            entry = self._new_entry()
+        if entry['length'] == self.state_size:
+            entry['keys'][:, :-1] = entry['keys'][:, 1:]
+            entry['values'][:, :-1] = entry['values'][:, 1:]
+            entry['length'] -= 1
+        position = entry['length']
+        seq = self.state_embeddings[item] + self.pos_embeddings[position]
+        for b, block in enumerate(self.blocks):
+            entry['keys'][b, position] = seq.dot(block['key'][0]) + block['key'][1]
+            entry['values'][b, position] = seq.dot(block['value'][0]) + block['value'][1]
+            queries = _layer_norm(seq, *block['ln_attention'])
+            query = queries.dot(block['query'][0]) + block['query'][1]
+            seq = self._attend(query, entry['keys'][b, :position + 1], entry['values'][b, :position + 1]) + queries
+            inputs = _layer_norm(seq, *block['ln_feedforward'])
+            outputs = np.maximum(inputs.dot(block['inner'][0]) + block['inner'][1], 0)
+            seq = outputs.dot(block['readout'][0]) + block['readout'][1] + inputs
+        entry['length'] = position + 1
+        entry['state_hidden'] = _layer_norm(seq, *self.final_norm).astype(np.float32)
+        self.cache.put(session_id, entry)
+        return entry['state_hidden']
+
+    def scores(self, session_id):
+        '''Head logits of all items for the current state of the session, the empty state before any click.'''
+        entry = self.cache.get(session_id)
+        state_hidden = self.empty_state if entry is None else entry['state_hidden']
+        return state_hidden.dot(self.head[0]) + self.head[1]
+
+    def end_session(self, session_id):
+        self.cache.pop(session_id)
+
+
+class HiddenStateStore(object):
+    '''Fixed-size float32 matrix of per-session vectors, evicting the least recently used session.
+
+    Each session owns one row; an evicted session's row is handed to the next
+    new one, so the memory stays at `max_sessions` x `size` floats.
+    '''
+    def __init__(self, size, max_sessions=100000):
+        self.vectors = np.zeros((max_sessions, size), dtype=np.float32)
+        self.rows = OrderedDict()
+        self.free_rows = list(range(max_sessions - 1, -1, -1))
+
+    def lookup(self, session_ids):
+        '''Rows of the sessions (distinct ids), new sessions get a zeroed row.'''
+        rows = np.empty(len(session_ids), dtype=np.int64)
+        for i, session_id in enumerate(session_ids):
+            row = self.rows.get(session_id)
+            if row is None:
+                if self.free_rows:
+                    row = self.free_rows.pop()
+                else:
+                    _, row = self.rows.popitem(last=False)
+                self.vectors[row] = 0
+                self.rows[session_id] = row
+            else:
+                self.rows.move_to_end(session_id)
+            rows[i] = row
+        return rows
+
+    def peek(self, session_ids, default):
+        '''Copies of the vectors of the sessions, `default` for unknown ones; leaves the store unchanged.'''
+        vectors = np.empty((len(session_ids), self.vectors.shape[1]), dtype=np.float32)
+        for i, session_id in enumerate(session_ids):
+            row = self.rows.get(session_id)
+            vectors[i] = default if row is None else self.vectors[row]
+        return vectors
+
+    def pop(self, session_id):
+        row = self.rows.pop(session_id, None)
+        if row is not None:
+            self.free_rows.append(row)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def _sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+class GRUStreamer(object):
+    '''Streaming QNetwork (GRU) encoder, one cell step per click.
+
+    Only the last hidden vector of a session is kept, in a HiddenStateStore,
+    and `append` advances the GRUCell by one step for each new click of a
+    batch of sessions. Up to `state_size` items this equals state_hidden of
+    the full network. Longer sessions keep the whole history in the state,
+    where the trainers truncate it to the last `state_size` items.
+    '''
+    def __init__(self, weights, head='ce-logits', max_sessions=100000):
+        self.state_embeddings = _embeddings(weights)
+        self.gate_kernel = _scoped(weights, '/rnn/', 'gates/kernel:0')[0]
+        self.gate_bias = _scoped(weights, '/rnn/', 'gates/bias:0')[0]
+        self.candidate_kernel = _scoped(weights, '/rnn/', 'candidate/kernel:0')[0]
+        self.candidate_bias = _scoped(weights, '/rnn/', 'candidate/bias:0')[0]
+        self.hidden_size = len(self.candidate_bias)
+        # the padded empty history, one step on the padding item (the last embedding) from zeros
+        self.empty_state = self._step(np.zeros((1, self.hidden_size), dtype=np.float32),
+                                      self.state_embeddings[-1:])[0]
+        self.head = _output_layer(weights, head)
+        self.store = HiddenStateStore(self.hidden_size, max_sessions)
+
+    def _step(self, state, inputs):
+        # tf.contrib.rnn.GRUCell
+        gates = _sigmoid(np.concatenate([inputs, state], axis=1).dot(self.gate_kernel) + self.gate_bias)
+        r, u = gates[:, :self.hidden_size], gates[:, self.hidden_size:]
+        candidate = np.tanh(np.concatenate([inputs, r * state], axis=1).dot(self.candidate_kernel)
+                            + self.candidate_bias)
+        return u * state + (1 - u) * candidate
+
+    def append(self, session_ids, items):
+        '''Adds one clicked item to each of the distinct sessions, returns their new state_hidden [batch, hidden].'''
+        rows = self.store.lookup(session_ids)
+        state = self._step(self.store.vectors[rows], self.state_embeddings[np.asarray(items)])
+        self.store.vectors[rows] = state
+        return state
+
+    def scores(self, session_ids):
+        '''Head logits of all items for the current states of the sessions, [batch, item_num].
+
+        Sessions without a click get the empty state.
+        '''
+        state = self.store.peek(session_ids, self.empty_state)
+        return state.dot(self.head[0]) + self.head[1]
+
+    def end_session(self, session_id):
+        self.store.pop(session_id)
+
+
+class NextItNetStreamer(object):
+    '''Fast-WaveNet style incremental NextItNet encoder.
+
+    A causal dilated convolution at step t only reads its input at t and at
+    (kernel_size - 1) earlier steps spaced by the dilation. Each convolution
+    of a session keeps those inputs in a ring buffer of
+    dilation * (kernel_size - 1) rows, so `append` runs one convolution step
+    per layer and the cost does not grow with the history. The residual
+    blocks, dilations and kernel size are read from the weights. Up to
+    `state_size` items this equals state_hidden of the full network; longer
+    sessions see their whole history through the receptive field, where the
+    trainers truncate it to the last `state_size` items.
+    '''
+    def __init__(self, weights, head='ce-logits', max_sessions=100000):
+        self.state_embeddings = _embeddings(weights)
+        block_pattern = re.compile(r'/nextitnet_residual_blockdecoder_layer_(\d+)_(\d+)/')
+        blocks = set(block_pattern.match(name).groups() for name in weights if block_pattern.match(name))
+        blocks = sorted(blocks, key=lambda block: int(block[0]))
+        self.convs = []
+        for layer_id, dilation in blocks:
+            prefix = '/nextitnet_residual_blockdecoder_layer_%s_%s/' % (layer_id, dilation)
+            for conv, norm, rate in [('dilated_conv1', 'layer_norm1', int(dilation)),
+                                     ('dilated_conv2', 'layer_norm2', 2 * int(dilation))]:
+                self.convs.append({
+                    'weight': weights[prefix + conv + '/weight:0'][0],  # [kernel_size, in, out]
+                    'bias': weights[prefix + conv + '/bias:0'],
+                    'norm': (weights[prefix + norm + '/Variable:0'], weights[prefix + norm + '/Variable_1:0']),
+                    'rate': rate})
+        # the padded empty history is masked to zeros after every block
+        self.empty_state = np.zeros(self.convs[-1]['bias'].shape, dtype=np.float32)
+        self.head = _output_layer(weights, head)
+        self.cache = SessionCache(max_sessions)
+
+    def _new_entry(self):
+        buffers = []
+        for conv in self.convs:
+            kernel_size, channels = conv['weight'].shape[:2]
+            buffers.append(np.zeros((conv['rate'] * (kernel_size - 1), channels), dtype=np.float32))
+        return {'buffers': buffers, 'step': 0, 'state_hidden': None}
+
+    def append(self, session_id, item):
+        '''Adds the clicked `item` to the session and returns its new state_hidden.'''
+        entry = self.cache.get(session_id)
+        if entry is None:
+            entry = self._new_entry()
+        step = entry['step']
+        x = self.state_embeddings[item]
+        for c, (conv, buffer) in enumerate(zip(self.convs, entry['buffers'])):
+            if c % 2 == 0:
+                block_input = x
+            kernel_size = len(conv['weight'])
+            # tap j reads the input (kernel_size - 1 - j) * rate steps back, zeros before the session start
+            out = x.dot(conv['weight'][-1]) + conv['bias']
+            for j in range(kernel_size - 1):
+                out += buffer[(step - (kernel_size - 1 - j) * conv['rate']) % len(buffer)].dot(conv['weight'][j])
+            buffer[step % len(buffer)] = x
+            x = np.maximum(_layer_norm(out, *conv['norm']), 0)
+            if c % 2 == 1:
+                x = block_input + x
+        entry['step'] = step + 1
+        entry['state_hidden'] = x.astype(np.float32)
+        self.cache.put(session_id, entry)
+        return entry['state_hidden']
+
+    def scores(self, session_id):
+        '''Head logits of all items for the current state of the session, the empty state before any click.'''
+        entry = self.cache.get(session_id)
+        state_hidden = self.empty_state if entry is None else entry['state_hidden']
+        return state_hidden.dot(self.head[0]) + self.head[1]
+
+    def end_session(self, session_id):
+        self.cache.pop(session_id)
@@ -5,6 +5,11 @@ from collections import deque
 import tensorflow as tf
 from multiprocessing import Process
 import queue
+import pickle
+import threading
+import multiprocessing
+import tempfile
+import shutil
 
 
 def to_pickled_df(data_directory, **kwargs):
@@ -35,6 +40,22 @@ def extract_axis_1(data, ind):
     return res
 
 
+def state_positions(inputs, len_state):
+    '''Rows of the flattened [N * T, C] sequence output the states are read from.
+
+    Defaults to the last item of every input, the rows extract_axis_1 would
+    take. Sequence-level training feeds the positions of all the transitions
+    of a batch of session windows instead, see SessionWindows.
+    '''
+    default = tf.range(tf.shape(inputs)[0]) * tf.shape(inputs)[1] + len_state - 1
+    return tf.placeholder_with_default(default, [None], name='positions')
+
+
+def gather_positions(data, positions):
+    '''Rows `positions` of the [N, T, C] tensor `data` flattened to [N * T, C].'''
+    return tf.gather(tf.reshape(data, [-1, data.get_shape()[-1].value]), positions)
+
+
 def normalize(inputs,
               epsilon=1e-8,
               scope="ln",
@@ -64,6 +85,16 @@ def normalize(inputs,
 
     return outputs
 
+def top_k_sorted(prediction, k):
+    '''The k best items of every row, the same as np.argsort(prediction)[:, -k:].
+
+    Uses a partial selection followed by a sort of only k columns, so one call
+    serves every cutoff <= k.
+    '''
+    top = np.argpartition(prediction, -k, axis=1)[:, -k:]
+    order = np.argsort(np.take_along_axis(prediction, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
 def calculate_hit(sorted_list,topk,true_items,rewards,r_click,total_reward,hit_click,ndcg_click,hit_purchase,ndcg_purchase):
     for i in range(len(topk)):
         rec_list = sorted_list[:, -topk[i]:]
@@ -78,6 +109,145 @@ def calculate_hit(sorted_list,topk,true_items,rewards,r_click,total_reward,hit_c
                     hit_purchase[i] += 1.0
                     ndcg_purchase[i] += 1.0 / np.log2(rank + 1)
 
+def target_ranks(prediction, true_items):
+    '''0-based rank of every target item, the number of other logits at or above the target logit.
+
+    Ties count against the target, and a NaN target logit gets the worst rank.
+    '''
+    target = prediction[np.arange(len(prediction)), true_items]
+    ranks = np.sum(prediction >= target[:, None], axis=1) - 1
+    return np.where(np.isnan(target), prediction.shape[1] - 1, ranks)
+
+def _rank_op(logits, target_logits):
+    '''Number of the other columns of `logits` at or above `target_logits`, the last rank for a NaN target.'''
+    ranks = tf.reduce_sum(tf.cast(tf.greater_equal(logits, tf.expand_dims(target_logits, 1)), tf.int32), axis=1) - 1
+    return tf.where(tf.is_nan(target_logits), tf.fill(tf.shape(ranks), tf.shape(logits)[1] - 1), ranks)
+
+def target_rank_op(logits, targets):
+    '''In-graph target_ranks: a [batch] int32 tensor, ties and NaN target logits count against the target.'''
+    return _rank_op(logits, extract_axis_1(logits, targets))
+
+def sampled_rank_op(state_hidden, scope, targets, negatives):
+    '''Rank of every target among its own sampled negatives.
+
+    Only the candidate columns of the output layer `scope` are computed,
+    through a gather on its kernel (or on the embeddings of a tied layer).
+
+    Args:
+      state_hidden: A 2d tensor [N, H], the input of the layer.
+      scope: The scope the layer was created with, e.g. "ce-logits".
+      targets: A 1d int tensor [N] of target items.
+      negatives: A 2d int tensor [N, num_negatives] of negative items.
+
+    Returns:
+      A [N] int32 tensor counting the negatives scored at or above the target,
+      num_negatives for a NaN target logit.
+    '''
+    candidates = tf.concat([tf.expand_dims(targets, 1), negatives], axis=1)
+    layer = _tied_layer(scope)
+    if layer is not None:
+        queries = _tied_queries(state_hidden, layer)  # [N, 1, E]
+        candidate_weights = tf.gather(layer['embeddings'], candidates)
+        logits = tf.reduce_sum(queries * candidate_weights, axis=2) + tf.gather(layer['biases'], candidates)
+        return _rank_op(logits, logits[:, 0])
+    with tf.variable_scope(scope, reuse=True):
+        weights = tf.get_variable('weights')
+        biases = tf.get_variable('biases')
+    candidate_weights = tf.gather(tf.transpose(weights), candidates)
+    logits = tf.reduce_sum(tf.expand_dims(state_hidden, 1) * candidate_weights, axis=2) + tf.gather(biases, candidates)
+    return _rank_op(logits, logits[:, 0])
+
+def calculate_rank_hit(ranks,topk,rewards,r_click,total_reward,hit_click,ndcg_click,hit_purchase,ndcg_purchase):
+    '''Vectorized calculate_hit over the target ranks of a batch.
+
+    A target tied with other items gets the worst rank of the tie, so
+    constant logits never count as hits.
+    '''
+    ranks = np.asarray(ranks)
+    rewards = np.asarray(rewards)
+    clicked = rewards == r_click
+    gain = 1.0 / np.log2(ranks + 2.0)
+    for i in range(len(topk)):
+        hit = ranks < topk[i]
+        total_reward[i] += np.sum(rewards[hit])
+        hit_click[i] += np.sum(hit & clicked)
+        ndcg_click[i] += np.sum(gain[hit & clicked])
+        hit_purchase[i] += np.sum(hit & ~clicked)
+        ndcg_purchase[i] += np.sum(gain[hit & ~clicked])
+
+def compile_eval_data(data_directory, state_size, item_num, name='sampled_test'):
+    '''Flattens the evaluation sessions into contiguous per-event arrays.
+
+    The arrays are cached as `<name>_compiled.npz` next to `<name>.df` and
+    rebuilt when the source is newer or the cache was compiled for another
+    state_size or item_num. Sessions keep the order of their first
+    appearance, events their order within the session.
+
+    Returns:
+      A dict with `states` [N, state_size] (padded with item_num), `len_states`,
+      `actions` and `is_buy` of the N test events, and `session_offsets`,
+      the index of the first event of every session followed by N.
+    '''
+    source = os.path.join(data_directory, name + '.df')
+    path = os.path.join(data_directory, name + '_compiled.npz')
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source):
+        with np.load(path) as compiled:
+            compiled = dict(compiled)
+        if compiled.get('shape_key', np.zeros(0)).tolist() == [state_size, item_num]:
+            del compiled['shape_key']
+            return compiled
+    eval_sessions = pd.read_pickle(source)
+    states, len_states, actions, is_buy, session_offsets = [], [], [], [], []
+    for _, group in eval_sessions.groupby('session_id', sort=False):
+        session_offsets.append(len(actions))
+        history = []
+        for item_id, buy in zip(group['item_id'], group['is_buy']):
+            len_states.append(state_size if len(history) >= state_size else 1 if len(history) == 0 else len(history))
+            states.append(pad_history(list(history), state_size, item_num))
+            actions.append(item_id)
+            is_buy.append(buy)
+            history.append(item_id)
+    session_offsets.append(len(actions))
+    compiled = {'states': np.array(states, dtype=np.int32).reshape(-1, state_size),
+                'len_states': np.array(len_states, dtype=np.int32),
+                'actions': np.array(actions, dtype=np.int64),
+                'is_buy': np.array(is_buy, dtype=np.int64),
+                'session_offsets': np.array(session_offsets, dtype=np.int64)}
+    np.savez(path, shape_key=np.array([state_size, item_num], dtype=np.int64), **compiled)
+    return compiled
+
+def compile_eval_negatives(data_directory, eval_data, item_num, num_negatives=100, name='sampled_test', seed=0):
+    '''Popularity-weighted negatives of every test event, cached next to the compiled test set.
+
+    Items are drawn with probability proportional to their count in the
+    replay buffer, with replacement, and never equal to the target.
+
+    Returns:
+      An int32 array [N, num_negatives] aligned with eval_data['actions'].
+    '''
+    path = os.path.join(data_directory, '%s_negatives%d.npz' % (name, num_negatives))
+    sources = [os.path.join(data_directory, name + '.df'), os.path.join(data_directory, 'replay_buffer.df')]
+    # rebuilt when the item space, the seed or the test set changed since it was cached
+    key = [num_negatives, item_num, seed, len(eval_data['actions'])]
+    if os.path.exists(path) and all(os.path.getmtime(path) >= os.path.getmtime(source) for source in sources):
+        with np.load(path) as compiled:
+            compiled = dict(compiled)
+        if compiled.get('key', np.zeros(0)).tolist() == key:
+            return compiled['negatives']
+    replay_buffer = pd.read_pickle(sources[1])
+    counts = np.bincount(np.asarray(replay_buffer['action'], dtype=np.int64), minlength=int(item_num))[:int(item_num)]
+    popularity = (counts + 1.0) / np.sum(counts + 1.0)
+    rng = np.random.RandomState(seed)
+    targets = eval_data['actions'][:, None]
+    negatives = rng.choice(int(item_num), size=(len(targets), num_negatives), p=popularity)
+    clash = negatives == targets
+    while clash.any():
+        negatives[clash] = rng.choice(int(item_num), size=int(clash.sum()), p=popularity)
+        clash = negatives == targets
+    negatives = negatives.astype(np.int32)
+    np.savez(path, key=np.array(key, dtype=np.int64), negatives=negatives)
+    return negatives
+
 class my_data_loader(object):
     def __init__(self, replay_buffer, batch_size=512):
         self.replay_buffer = replay_buffer
@@ -105,11 +275,839 @@ class my_data_loader(object):
         # child_process_for_put.join()
 
 # REM采样
-def make_coeff(num_heads):
-    arr = np.random.uniform(low=0.0, high=1.0, size=num_heads)
+def make_coeff(num_heads, rng=None):
+    rng = np.random if rng is None else rng
+    arr = rng.uniform(low=0.0, high=1.0, size=num_heads)
     arr /= np.sum(arr)
     return arr.astype(np.float32)
 
+def output_layer(inputs, num_items, scope, num_heads=1, tied_embeddings=None):
+    '''Item output layer, [N, num_items * num_heads] with column item * num_heads + head.
+
+    A fully_connected layer, or with `tied_embeddings` (the [item_num + 1, E]
+    state_embeddings table) a layer whose kernel is the transposed table:
+    logits = inputs @ projection @ E[:num_items].T + biases. The projection
+    [C_in, num_heads * E] maps the input to one E-dimensional query per head;
+    it is left out for a single head when C_in == E. The tied layer only
+    adds the biases and the projection, and is registered in the
+    'tied_output_layers' collection for gather_fc_columns and friends.
+    '''
+    if tied_embeddings is None:
+        return tf.contrib.layers.fully_connected(inputs, num_items * num_heads, activation_fn=None, scope=scope)
+    in_size = inputs.get_shape()[-1].value
+    embedding_size = tied_embeddings.get_shape()[-1].value
+    with tf.variable_scope(scope) as layer_scope:
+        biases = tf.get_variable('biases', [num_items * num_heads], initializer=tf.zeros_initializer())
+        projection = None
+        if num_heads > 1 or in_size != embedding_size:
+            projection = tf.get_variable('projection', [in_size, num_heads * embedding_size],
+                                         initializer=tf.contrib.layers.xavier_initializer())
+    layer = {'name': layer_scope.name, 'embeddings': tied_embeddings[:num_items], 'projection': projection,
+             'num_heads': num_heads, 'biases': biases}
+    tf.add_to_collection('tied_output_layers', layer)
+    logits = tf.einsum('nkh,ih->nik', _tied_queries(inputs, layer), layer['embeddings'])
+    return tf.reshape(logits, [tf.shape(inputs)[0], num_items * num_heads]) + biases
+
+def _tied_layer(scope):
+    '''The tied_output_layers entry of `scope`, None for a fully_connected layer.'''
+    with tf.variable_scope(scope, reuse=True) as layer_scope:
+        name = layer_scope.name
+    for layer in tf.get_collection('tied_output_layers'):
+        if layer['name'] == name:
+            return layer
+    return None
+
+def _tied_queries(inputs, layer):
+    '''Per-head queries of a tied layer, [N, num_heads, E].'''
+    if layer['projection'] is None:
+        return tf.expand_dims(inputs, 1)
+    embedding_size = layer['embeddings'].get_shape()[-1].value
+    return tf.reshape(tf.matmul(inputs, layer['projection']), [-1, layer['num_heads'], embedding_size])
+
+def gather_fc_columns(inputs, scope, columns):
+    '''Applies only the output columns `columns` of a fully_connected layer.
+
+    Args:
+      inputs: A 2d tensor with shape of [N, C_in], the input of the layer.
+      scope: The scope the layer was created with, e.g. "ce-logits".
+      columns: A 1d int tensor of output units to compute.
+
+    Returns:
+      A 2d tensor with shape of [N, len(columns)].
+    '''
+    layer = _tied_layer(scope)
+    if layer is not None:
+        num_heads = layer['num_heads']
+        queries = tf.gather(_tied_queries(inputs, layer), columns % num_heads, axis=1)  # [N, len(columns), E]
+        column_embeddings = tf.gather(layer['embeddings'], columns // num_heads)
+        return tf.reduce_sum(queries * column_embeddings, axis=2) + tf.gather(layer['biases'], columns)
+    with tf.variable_scope(scope, reuse=True):
+        weights = tf.get_variable('weights')
+        biases = tf.get_variable('biases')
+    return tf.matmul(inputs, tf.gather(weights, columns, axis=1)) + tf.gather(biases, columns)
+
+def candidate_multi_head_output(state_hidden, candidates, num_multi_head, scope='multi-head'):
+    '''Multi-head Q-values of the candidate items only, shape [N, len(candidates), num_multi_head].'''
+    heads = tf.range(num_multi_head)
+    columns = tf.reshape(tf.expand_dims(candidates, 1) * num_multi_head + tf.expand_dims(heads, 0), [-1])
+    layer = _tied_layer(scope)
+    if layer is not None:
+        # one [N, heads, E] x [candidates, E] product instead of a gather per column
+        output = tf.einsum('nkh,ch->nck', _tied_queries(state_hidden, layer),
+                           tf.gather(layer['embeddings'], candidates))
+        return output + tf.reshape(tf.gather(layer['biases'], columns), [tf.shape(candidates)[0], num_multi_head])
+    output = gather_fc_columns(state_hidden, scope, columns)
+    return tf.reshape(output, (tf.shape(output)[0], tf.shape(candidates)[0], num_multi_head))
+
+class CandidateSampler(object):
+    '''Per-batch candidate items for the Q-learning targets.
+
+    The candidate set is the union of the batch actions, the most popular
+    items of the replay buffer and uniformly sampled negatives.
+    '''
+    def __init__(self, replay_buffer, item_num, num_popular=1000, num_negatives=1000):
+        self.item_num = int(item_num)
+        self.num_negatives = num_negatives
+        counts = np.bincount(np.asarray(replay_buffer['action'], dtype=np.int64), minlength=self.item_num)
+        self.popular = np.argsort(-counts, kind='mergesort')[:num_popular]
+
+    def sample(self, actions):
+        negatives = np.random.randint(0, self.item_num, size=self.num_negatives)
+        return np.unique(np.concatenate([np.asarray(actions), self.popular, negatives])).astype(np.int32)
+
+class SessionWindows(object):
+    '''The sessions of the replay buffer cut into windows of state_size items, for sequence-level training.
+
+    The replay buffer holds the transitions of every session in order, the
+    last one with is_done. A causal encoder run over the items e_o .. e_o+S-1
+    of a session yields at position j the state after e_o+j, so all the
+    transitions whose state and next state fall into a window read both
+    from one forward pass. The first window of a session starts at its first
+    item and reproduces the states of the replay buffer; every further
+    window advances by `stride` items and trains only the transitions the
+    previous one could not reach. Each transition is trained once per epoch,
+    with at least state_size - stride items of history. The empty state of
+    the first transition is read from an all-padding row appended to every
+    batch.
+    '''
+    def __init__(self, replay_buffer, state_size, item_num, stride):
+        assert 1 <= stride < state_size, 'the window stride must be in [1, state_size)'
+        self.state_size = int(state_size)
+        self.item_num = int(item_num)
+        actions = np.asarray(replay_buffer['action'], dtype=np.int32)
+        is_buy = np.asarray(replay_buffer['is_buy'], dtype=np.int64)
+        ends = np.flatnonzero(np.asarray(replay_buffer['is_done'], dtype=bool)) + 1
+        windows, counts, columns = [], [], {'position': [], 'next_position': [], 'action': [], 'is_buy': [],
+                                            'is_done': []}
+        for start, end in zip(np.concatenate([[0], ends[:-1]]), ends):
+            offset, first = 0, 0
+            while first < end - start:
+                # transitions first .. last - 1, whose next state ends inside the window
+                last = min(offset + self.state_size, end - start)
+                steps = np.arange(first, last)
+                windows.append(pad_history(list(actions[start + offset:start + last]), self.state_size,
+                                           self.item_num))
+                counts.append(last - first)
+                columns['position'].append(steps - 1 - offset)  # -1 for the empty state
+                columns['next_position'].append(steps - offset)
+                columns['action'].append(actions[start + steps])
+                columns['is_buy'].append(is_buy[start + steps])
+                columns['is_done'].append(steps == end - start - 1)
+                first = last
+                offset += stride
+        self.windows = np.array(windows, dtype=np.int32).reshape(-1, self.state_size)
+        self.transition_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.transitions = dict((key, np.concatenate(column)) for key, column in columns.items())
+        self.active = np.arange(len(self.windows))
+
+    def __len__(self):
+        return len(self.active)
+
+    def shard(self, rank, num_shards):
+        '''Keeps every num_shards-th window, starting at `rank`.'''
+        self.active = self.active[rank::num_shards]
+
+    def sample(self, batch_size, rng=None):
+        '''A batch of windows without replacement and all the transitions they train.
+
+        Returns:
+          A dict with `inputs` [batch_size + 1, state_size], the windows and the
+          padding row, `positions` and `next_positions`, the rows of the
+          flattened encoder output holding the state and the next state of
+          every transition, and its `action`, `is_buy` and `is_done`.
+        '''
+        rng = np.random if rng is None else rng
+        ids = self.active[rng.choice(len(self.active), batch_size, replace=False)]
+        counts = self.transition_offsets[ids + 1] - self.transition_offsets[ids]
+        rows = np.repeat(np.arange(batch_size), counts)
+        index = np.arange(counts.sum()) + np.repeat(self.transition_offsets[ids] - (np.cumsum(counts) - counts), counts)
+        batch = dict((key, column[index]) for key, column in self.transitions.items())
+        padding_row = np.full((1, self.state_size), self.item_num, dtype=np.int32)
+        batch['inputs'] = np.concatenate([self.windows[ids], padding_row])
+        batch['positions'] = np.where(batch['position'] < 0, batch_size * self.state_size,
+                                      rows * self.state_size + batch['position'])
+        batch['next_positions'] = rows * self.state_size + batch['next_position']
+        return batch
+
+class SessionParallelSampler(object):
+    '''GRU4Rec-style session-parallel batches over the sessions of the replay buffer.
+
+    Each of the batch_size slots walks through one session, one transition
+    per step, and moves on to the next session of a shuffled queue after
+    the transition with is_done. A recurrent encoder can then carry the
+    hidden state of every slot from step to step and advance it by the
+    previous item only, resetting it where `is_first` marks a new session.
+    '''
+    def __init__(self, replay_buffer, batch_size, item_num):
+        self.item_num = int(item_num)
+        self.actions = np.asarray(replay_buffer['action'], dtype=np.int32)
+        self.is_buy = np.asarray(replay_buffer['is_buy'], dtype=np.int64)
+        self.is_done = np.asarray(replay_buffer['is_done'], dtype=bool)
+        ends = np.flatnonzero(self.is_done) + 1
+        self.starts = np.concatenate([[0], ends[:-1]]).astype(np.int64)
+        self.is_first = np.zeros(len(self.actions), dtype=bool)
+        self.is_first[self.starts] = True
+        self.batch_size = batch_size
+        self.queue = np.zeros(0, dtype=np.int64)
+        self.cursor = None
+
+    def shard(self, rank, num_shards):
+        '''Keeps every num_shards-th session, starting at `rank`.'''
+        self.starts = self.starts[rank::num_shards]
+
+    def _next_sessions(self, n, rng):
+        while len(self.queue) < n:
+            self.queue = np.concatenate([self.queue, rng.permutation(self.starts)])
+        sessions, self.queue = self.queue[:n], self.queue[n:]
+        return sessions
+
+    def sample(self, rng=None):
+        '''The current transition of every slot, then moves the slots one step on.
+
+        Returns:
+          A dict with the `action`, `is_buy` and `is_done` of the batch_size
+          transitions, `previous`, the item before the action (item_num at
+          the start of a session, as in the padded states), and `is_first`.
+        '''
+        rng = np.random if rng is None else rng
+        if self.cursor is None:
+            self.cursor = self._next_sessions(self.batch_size, rng)
+        rows = self.cursor
+        is_first = self.is_first[rows]
+        batch = {'action': self.actions[rows], 'is_buy': self.is_buy[rows], 'is_done': self.is_done[rows],
+                 'previous': np.where(is_first, self.item_num, self.actions[rows - 1]), 'is_first': is_first}
+        self.cursor = rows + 1
+        if batch['is_done'].any():
+            self.cursor[batch['is_done']] = self._next_sessions(int(batch['is_done'].sum()), rng)
+        return batch
+
+def target_update_op(online_scope, target_scope, tau=1.0):
+    '''Moves the target copy towards the online network, target <- tau * online + (1 - tau) * target.
+
+    With tau=1.0 the online weights are copied over. Variables are paired by
+    their name below the network scope.
+    '''
+    online_vars = dict((var.name[len(online_scope):], var)
+                       for var in tf.trainable_variables() if var.name.startswith(online_scope + '/'))
+    target_vars = dict((var.name[len(target_scope):], var)
+                       for var in tf.trainable_variables() if var.name.startswith(target_scope + '/'))
+    updates = []
+    for name in sorted(target_vars):
+        target = target_vars[name]
+        online = online_vars[name]
+        if tau == 1.0:
+            updates.append(tf.assign(target, online))
+        else:
+            updates.append(tf.assign(target, tau * online + (1 - tau) * target))
+    return tf.group(*updates)
+
+class Checkpointer(object):
+    '''Periodic checkpoints of every graph variable and of the training loop state.
+
+    A checkpoint holds all global variables (both networks and their optimizer
+    slots), the numpy RNG state, the states of the named RandomStates in
+    `rngs`, `total_step` and the accumulated logs passed as keyword arguments.
+    Variable values are fetched in the training thread and written to disk by
+    a background thread, so training only stalls for the fetch.
+
+    With `allreduce`, every worker calls maybe_save at the same steps, rank 0
+    writes the checkpoint with the RandomState states of all workers, and
+    each worker restores its own.
+    '''
+    def __init__(self, sess, checkpoint_dir, every, keep=2, rngs=None, allreduce=None):
+        self.sess = sess
+        self.checkpoint_dir = checkpoint_dir
+        self.every = every
+        self.keep = keep
+        self.variables = tf.global_variables()
+        self.rngs = dict((name, rng) for name, rng in (rngs or {}).items() if rng is not None)
+        self.allreduce = allreduce
+        self.rank = 0 if allreduce is None else allreduce.rank
+        self.last_step = 0
+        self.writer = None
+
+    def due(self, total_step):
+        '''True if maybe_save writes a checkpoint at `total_step`.'''
+        return self.every > 0 and total_step != self.last_step and total_step % self.every == 0
+
+    def maybe_save(self, total_step, **logs):
+        if self.due(total_step):
+            self.save(total_step, **logs)
+
+    def finish(self, total_step, **logs):
+        '''Checkpoints the trained state after the last step, if not saved yet, and waits for the writer.'''
+        if self.every > 0 and total_step != self.last_step:
+            self.save(total_step, **logs)
+        self.wait()
+
+    def save(self, total_step, **logs):
+        rng_states = dict((name, rng.get_state()) for name, rng in self.rngs.items())
+        rng_states = [rng_states] if self.allreduce is None else self.allreduce.gather_objects(rng_states)
+        self.last_step = total_step
+        if self.rank != 0:
+            return
+        values = self.sess.run(self.variables)
+        checkpoint = {'variables': {var.name: value for var, value in zip(self.variables, values)},
+                      'total_step': total_step,
+                      'rng_state': np.random.get_state(),
+                      'rng_states': rng_states,
+                      'logs': {name: list(log) for name, log in logs.items()}}
+        self.wait()
+        self.writer = threading.Thread(target=self._write, args=(checkpoint,))
+        self.writer.start()
+
+    def wait(self):
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+
+    def _write(self, checkpoint):
+        if not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        path = os.path.join(self.checkpoint_dir, 'ckpt-%d.pkl' % checkpoint['total_step'])
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+        for old in self._checkpoints()[:-self.keep]:
+            os.remove(old)
+
+    def _checkpoints(self):
+        if not os.path.exists(self.checkpoint_dir):
+            return []
+        steps = [int(f[len('ckpt-'):-len('.pkl')]) for f in os.listdir(self.checkpoint_dir)
+                 if f.startswith('ckpt-') and f.endswith('.pkl')]
+        return [os.path.join(self.checkpoint_dir, 'ckpt-%d.pkl' % step) for step in sorted(steps)]
+
+    def restore(self, **logs):
+        '''Loads the latest checkpoint, refills `logs` in place and returns its total_step (0 if none).'''
+        checkpoints = self._checkpoints()
+        if not checkpoints:
+            print('no checkpoint found in %s, training from scratch' % self.checkpoint_dir)
+            return 0
+        with open(checkpoints[-1], 'rb') as f:
+            checkpoint = pickle.load(f)
+        for var in self.variables:
+            var.load(checkpoint['variables'][var.name], self.sess)
+        np.random.set_state(checkpoint['rng_state'])
+        rng_states = checkpoint.get('rng_states', [])
+        if self.rank < len(rng_states):
+            for name, rng in self.rngs.items():
+                if name in rng_states[self.rank]:
+                    rng.set_state(rng_states[self.rank][name])
+        for name, log in logs.items():
+            log[:] = checkpoint['logs'].get(name, [])
+        self.last_step = checkpoint['total_step']
+        print('resumed from %s' % checkpoints[-1])
+        return checkpoint['total_step']
+
+# session-length buckets of the extended metrics, by len_states of the test event
+LENGTH_BUCKET_EDGES = [2, 4, 6]
+LENGTH_BUCKET_NAMES = ['len0-1', 'len2-3', 'len4-5', 'len6+']
+
+def item_popularity(data_directory, item_num):
+    '''Share of the replay-buffer interactions of every item.'''
+    replay_buffer = pd.read_pickle(os.path.join(data_directory, 'replay_buffer.df'))
+    counts = np.bincount(np.asarray(replay_buffer['action'], dtype=np.int64), minlength=int(item_num))[:int(item_num)]
+    return counts / float(np.sum(counts))
+
+def extended_metric_names(topk):
+    '''Column names of EvalAccumulator.extended(), in order.'''
+    names = ['mrr']
+    names += ['cov@%d' % k for k in topk] + ['arp@%d' % k for k in topk]
+    for bucket in LENGTH_BUCKET_NAMES:
+        names += ['hr_%s@%d' % (bucket, k) for k in topk] + ['ng_%s@%d' % (bucket, k) for k in topk]
+    return names
+
+class EvalAccumulator(object):
+    '''Metric sums of a part of the test set.
+
+    Accumulators of disjoint parts are merged by adding them up, so sharded
+    evaluation gives the same totals as a single pass. Besides reward, HR and
+    NDCG it collects the extended metrics: MRR, catalogue coverage and average
+    recommendation popularity (ARP) of the top-k lists when `popularity` is
+    given, and HR and NDCG by session-length bucket.
+    '''
+    def __init__(self, topk, popularity=None):
+        self.topk = topk
+        self.total_clicks = 0.0
+        self.total_purchase = 0.0
+        self.total_reward = np.zeros(len(topk))
+        self.hit_clicks = np.zeros(len(topk))
+        self.ndcg_clicks = np.zeros(len(topk))
+        self.hit_purchase = np.zeros(len(topk))
+        self.ndcg_purchase = np.zeros(len(topk))
+        self.popularity = popularity
+        self.reciprocal_rank = 0.0
+        self.num_listed = 0
+        self.recommended = None if popularity is None else np.zeros((len(topk), len(popularity)), dtype=bool)
+        self.recommended_popularity = np.zeros(len(topk))
+        self.bucket_events = np.zeros(len(LENGTH_BUCKET_NAMES))
+        self.bucket_hits = np.zeros((len(LENGTH_BUCKET_NAMES), len(topk)))
+        self.bucket_ndcg = np.zeros((len(LENGTH_BUCKET_NAMES), len(topk)))
+
+    def add(self, ranks, rewards, r_click, top_items=None, buckets=None):
+        '''Adds a batch; `top_items` [batch, max(topk)] best first, `buckets` the length bucket of every event.'''
+        ranks = np.asarray(ranks)
+        rewards = np.asarray(rewards)
+        self.total_clicks += np.sum(rewards == r_click)
+        self.total_purchase += np.sum(rewards != r_click)
+        calculate_rank_hit(ranks, self.topk, rewards, r_click, self.total_reward,
+                           self.hit_clicks, self.ndcg_clicks, self.hit_purchase, self.ndcg_purchase)
+        self.reciprocal_rank += np.sum(1.0 / (ranks + 1.0))
+        if buckets is not None:
+            num_buckets = len(LENGTH_BUCKET_NAMES)
+            gain = 1.0 / np.log2(ranks + 2.0)
+            self.bucket_events += np.bincount(buckets, minlength=num_buckets)
+            for i in range(len(self.topk)):
+                hit = ranks < self.topk[i]
+                self.bucket_hits[:, i] += np.bincount(buckets, weights=hit, minlength=num_buckets)
+                self.bucket_ndcg[:, i] += np.bincount(buckets, weights=gain * hit, minlength=num_buckets)
+        if top_items is not None and self.recommended is not None:
+            self.num_listed += len(top_items)
+            for i in range(len(self.topk)):
+                best = top_items[:, :self.topk[i]]
+                self.recommended[i, best.ravel()] = True
+                self.recommended_popularity[i] += np.sum(self.popularity[best])
+
+    def merge(self, other):
+        self.total_clicks += other.total_clicks
+        self.total_purchase += other.total_purchase
+        self.total_reward += other.total_reward
+        self.hit_clicks += other.hit_clicks
+        self.ndcg_clicks += other.ndcg_clicks
+        self.hit_purchase += other.hit_purchase
+        self.ndcg_purchase += other.ndcg_purchase
+        self.reciprocal_rank += other.reciprocal_rank
+        self.num_listed += other.num_listed
+        if self.recommended is not None:
+            self.recommended |= other.recommended
+        self.recommended_popularity += other.recommended_popularity
+        self.bucket_events += other.bucket_events
+        self.bucket_hits += other.bucket_hits
+        self.bucket_ndcg += other.bucket_ndcg
+        return self
+
+    def extended(self):
+        '''The extended metrics in the order of extended_metric_names, nan where nothing was collected.'''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = [self.reciprocal_rank / (self.total_clicks + self.total_purchase)]
+            if self.recommended is not None and self.num_listed > 0:
+                values += list(self.recommended.mean(axis=1))
+                values += list(self.recommended_popularity / (self.num_listed * np.asarray(self.topk)))
+            else:
+                values += [np.nan] * (2 * len(self.topk))
+            for b in range(len(LENGTH_BUCKET_NAMES)):
+                values += list(self.bucket_hits[b] / self.bucket_events[b])
+                values += list(self.bucket_ndcg[b] / self.bucket_events[b])
+        return np.array(values, dtype=np.float64)
+
+    def result(self, extended=False, verbose=True):
+        '''Returns the metrics in the log_data row layout, followed by extended() if asked; prints them if `verbose`.'''
+        topk = self.topk
+        best_rec = [[0,0,0,0,0] for _ in topk]
+        for i in range(len(topk)):
+            hr_click=self.hit_clicks[i]/self.total_clicks
+            hr_purchase=self.hit_purchase[i]/self.total_purchase
+            ng_click=self.ndcg_clicks[i]/self.total_clicks
+            ng_purchase=self.ndcg_purchase[i]/self.total_purchase
+            if verbose:
+                print('\t\t'* (topk[i] // 5) + 'reward  @%d : %f' % (topk[i],self.total_reward[i]))
+                print('\t\t'* (topk[i] // 5) + 'c hr ng @%d : %f, %f' % (topk[i],hr_click,ng_click))
+                print('\t\t'* (topk[i] // 5) + 'p hr ng @%d : %f, %f' % (topk[i], hr_purchase, ng_purchase))
+
+            best_rec[i][0] = self.total_reward[i]
+            best_rec[i][1] = hr_click
+            best_rec[i][2] = float(ng_click)
+            best_rec[i][3] = hr_purchase
+            best_rec[i][4] = float(ng_purchase)
+
+        row = np.array(best_rec).reshape(1, -1)[0]
+        if not extended:
+            return row
+        values = self.extended()
+        if verbose:
+            print('mrr : %f' % values[0])
+            for i in range(len(topk)):
+                print('\t\t'* (topk[i] // 5) + 'cov arp @%d : %f, %f' % (topk[i], values[1 + i], values[1 + len(topk) + i]))
+        return np.concatenate([row, values])
+
+def head_results(accumulators, q_columns=False):
+    '''log_data row of an evaluate_network result.
+
+    The CE head is printed as usual. With `q_columns` its row is followed by
+    the same metrics of the Q head, printed next to the CE values, or by nan
+    when the Q head was not ranked (sampled evaluation).
+    '''
+    if isinstance(accumulators, EvalAccumulator):
+        accumulators = (accumulators,)
+    row = accumulators[0].result(extended=True)
+    if not q_columns:
+        return row
+    if len(accumulators) < 2:
+        return np.concatenate([row, np.full(len(row), np.nan)])
+    q_row = accumulators[1].result(extended=True, verbose=False)
+    topk = accumulators[0].topk
+    names = []
+    for k in topk:
+        names += ['rew@%d' % k, 'hr_c@%d' % k, 'ng_c@%d' % k, 'hr_p@%d' % k, 'ng_p@%d' % k]
+    names += extended_metric_names(topk)[:1 + 2 * len(topk)]
+    print('%-10s %12s %12s' % ('', 'ce-logits', 'q-value'))
+    for i in range(len(names)):
+        print('%-10s %12f %12f' % (names[i], row[i], q_row[i]))
+    return np.concatenate([row, q_row])
+
+def evaluate_network(sess, network, eval_data, topk, reward_click, reward_buy, batch=100, shard=0, num_shards=1,
+                     sampled=False, q_head=None):
+    '''EvalAccumulator of one shard of the compiled test set.
+
+    The sessions are cut into batches of `batch` whole sessions and the shard
+    takes every num_shards-th batch, starting at batch `shard`. `network` is
+    any backbone with the inputs, len_state, eval_targets and target_rank
+    attributes. With `sampled` the targets are ranked against
+    eval_data['negatives'] through network.sampled_rank instead of all items.
+    The extended metrics use eval_data['popularity'] and
+    eval_data['length_bucket'] when present.
+
+    With `q_head` set (to the add_penalty value) the Q-values output1 with
+    uniform head coefficients are ranked in the same sess.run as the CE
+    logits, and the result is the pair (CE accumulator, Q accumulator). The
+    Q head is only ranked against all items, `sampled` ignores it.
+    '''
+    session_offsets = eval_data['session_offsets']
+    num_sessions = len(session_offsets) - 1
+    popularity = eval_data.get('popularity')
+    list_items = popularity is not None and not sampled and hasattr(network, 'top_items')
+    q_head = None if sampled else q_head
+    accumulator = EvalAccumulator(topk, popularity)
+    q_accumulator = EvalAccumulator(topk, popularity)
+    for first in range(shard * batch, num_sessions, num_shards * batch):
+        begin = session_offsets[first]
+        end = session_offsets[min(first + batch, num_sessions)]
+        feed_dict = {network.inputs: eval_data['states'][begin:end],
+                     network.len_state: eval_data['len_states'][begin:end],
+                     network.eval_targets: eval_data['actions'][begin:end]}
+        if hasattr(network, 'is_training'):
+            feed_dict[network.is_training] = False
+        if sampled:
+            feed_dict[network.eval_negatives] = eval_data['negatives'][begin:end]
+        fetches = [network.sampled_rank if sampled else network.target_rank]
+        if list_items:
+            fetches.append(network.top_items)
+        if q_head is not None:
+            feed_dict[network.rco] = np.full(network.num_multi_head, 1.0 / network.num_multi_head)
+            feed_dict[network.add_penalty] = q_head
+            fetches.append(network.q_target_rank)
+            if list_items:
+                fetches.append(network.q_top_items)
+        results = sess.run(fetches, feed_dict=feed_dict)
+        rewards = np.where(eval_data['is_buy'][begin:end] == 1, reward_buy, reward_click)
+        buckets = eval_data['length_bucket'][begin:end] if 'length_bucket' in eval_data else None
+        step = 2 if list_items else 1
+        accumulator.add(results[0], rewards, reward_click, results[1] if list_items else None, buckets)
+        if q_head is not None:
+            q_accumulator.add(results[step], rewards, reward_click, results[step + 1] if list_items else None, buckets)
+    if q_head is not None:
+        return accumulator, q_accumulator
+    return accumulator
+
+def scope_weights(sess, scope):
+    '''Values of the trainable variables of `scope`, keyed by their name below the scope.'''
+    variables = [var for var in tf.trainable_variables() if var.name.startswith(scope + '/')]
+    return dict((var.name[len(scope):], value) for var, value in zip(variables, sess.run(variables)))
+
+class ShardedEvaluator(object):
+    '''Evaluates the test set in worker processes, each one scoring a shard of the sessions.
+
+    The workers are forked after the graph is built and before any session
+    exists. Each one opens its own session with a share of the cores, loads
+    the weights it is sent into the network of `scope` and returns the
+    EvalAccumulator of `evaluate_shard(sess, *args, shard=rank, num_shards=N)`.
+    The partial accumulators are merged in the calling process.
+    '''
+    def __init__(self, num_workers, scope, evaluate_shard):
+        self.scope = scope
+        self.pipes = []
+        self.pids = []
+        for rank in range(num_workers):
+            parent_end, child_end = multiprocessing.Pipe()
+            pid = os.fork()
+            if pid == 0:
+                parent_end.close()
+                try:
+                    self._serve(rank, num_workers, child_end, evaluate_shard)
+                finally:
+                    os._exit(0)
+            child_end.close()
+            self.pipes.append(parent_end)
+            self.pids.append(pid)
+
+    def _serve(self, rank, num_workers, conn, evaluate_shard):
+        variables = dict((var.name[len(self.scope):], var) for var in tf.trainable_variables()
+                         if var.name.startswith(self.scope + '/'))
+        threads = max(1, multiprocessing.cpu_count() // num_workers)
+        config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            while True:
+                request = conn.recv()
+                if request is None:
+                    break
+                weights, args = request
+                try:
+                    for name, value in weights.items():
+                        variables[name].load(value, sess)
+                    conn.send(evaluate_shard(sess, *args, shard=rank, num_shards=num_workers))
+                except Exception as e:
+                    conn.send(e)
+
+    def evaluate(self, weights, *args):
+        '''Scores `weights` (see scope_weights) and returns the merged EvalAccumulator (one per head).'''
+        for conn in self.pipes:
+            conn.send((weights, args))
+        partials = [conn.recv() for conn in self.pipes]
+        for partial in partials:
+            if isinstance(partial, Exception):
+                raise partial
+        accumulator = partials[0]
+        for partial in partials[1:]:
+            if isinstance(partial, tuple):
+                for head, head_partial in zip(accumulator, partial):
+                    head.merge(head_partial)
+            else:
+                accumulator.merge(partial)
+        return accumulator
+
+    def close(self):
+        for conn in self.pipes:
+            conn.send(None)
+        for pid in self.pids:
+            os.waitpid(pid, 0)
+
+class AsyncEvaluator(object):
+    '''Scores weight snapshots in a background thread while training continues.
+
+    `snapshot_op` copies the online network into a frozen evaluation copy and
+    `evaluate(sess, *args)` scores that copy. Only one snapshot is scored at a
+    time; finished results are collected with `drain`.
+    '''
+    def __init__(self, sess, snapshot_op, evaluate):
+        self.sess = sess
+        self.snapshot_op = snapshot_op
+        self.evaluate = evaluate
+        self.thread = None
+        self.lock = threading.Lock()
+        self.results = []
+
+    def submit(self, step, *args):
+        self.wait()
+        self.sess.run(self.snapshot_op)
+        self.thread = threading.Thread(target=self._run, args=(step,) + args)
+        self.thread.start()
+
+    def _run(self, step, *args):
+        result = self.evaluate(self.sess, *args)
+        with self.lock:
+            self.results.append((step, result))
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def drain(self):
+        '''Returns the (step, result) pairs finished since the last call.'''
+        with self.lock:
+            results, self.results = self.results, []
+        return results
+
+class SharedMemoryAllreduce(object):
+    '''Averages gradients across data-parallel worker processes on one host.
+
+    The workers are forked from the trainer process after the graph is built
+    and before the session is created. Every worker writes its flattened
+    gradients into its own memory-mapped slot, averages a 1/N chunk of all
+    slots into a shared result buffer and reads the whole average back, so
+    each worker applies the same update and the replicas stay in sync.
+    '''
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.rank = 0
+        self.children = []
+        self.barrier = multiprocessing.Barrier(num_workers)
+        shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self.directory = tempfile.mkdtemp(prefix='allreduce-', dir=shm)
+        self.slots = None
+
+    def fork(self):
+        '''Forks num_workers - 1 workers and returns the rank of the calling process.'''
+        for rank in range(1, self.num_workers):
+            pid = os.fork()
+            if pid == 0:
+                self.rank = rank
+                self.children = []
+                return rank
+            self.children.append(pid)
+        return 0
+
+    def session_config(self, gpu_options):
+        '''Splits the host cores between the workers.'''
+        threads = max(1, multiprocessing.cpu_count() // self.num_workers)
+        return tf.ConfigProto(gpu_options=gpu_options, intra_op_parallelism_threads=threads,
+                              inter_op_parallelism_threads=2)
+
+    def _memmap(self, name, mode, size, dtype=np.float32):
+        return np.memmap(os.path.join(self.directory, name), dtype=dtype, mode=mode, shape=(size,))
+
+    def _open(self, size):
+        self._memmap('slot-%d' % self.rank, 'w+', size)
+        if self.rank == 0:
+            self._memmap('result', 'w+', size)
+        self.barrier.wait()
+        self.slots = [self._memmap('slot-%d' % rank, 'r+', size) for rank in range(self.num_workers)]
+        self.result = self._memmap('result', 'r+', size)
+        bounds = np.linspace(0, size, self.num_workers + 1).astype(np.int64)
+        self.chunk = slice(bounds[self.rank], bounds[self.rank + 1])
+
+    def allreduce(self, *grads):
+        flat = np.concatenate([np.ravel(g) for g in grads]).astype(np.float32)
+        if self.slots is None:
+            self._open(flat.size)
+        self.slots[self.rank][:] = flat
+        self.barrier.wait()
+        total = np.array(self.slots[0][self.chunk])
+        for slot in self.slots[1:]:
+            total += slot[self.chunk]
+        self.result[self.chunk] = total / self.num_workers
+        self.barrier.wait()
+        averaged = np.array(self.result)
+        outputs, offset = [], 0
+        for g in grads:
+            outputs.append(averaged[offset:offset + np.size(g)].reshape(np.shape(g)))
+            offset += np.size(g)
+        return outputs
+
+    def broadcast(self, *values):
+        '''Rank 0's `values` on every worker, as float32 arrays of the same shapes.'''
+        flat = np.concatenate([np.ravel(v) for v in values]).astype(np.float32)
+        if self.rank == 0:
+            shared = self._memmap('broadcast', 'w+', flat.size)
+            shared[:] = flat
+            shared.flush()
+        self.barrier.wait()
+        flat = np.array(self._memmap('broadcast', 'r', flat.size))
+        self.barrier.wait()  # rank 0 may not overwrite the buffer before everyone has read it
+        outputs, offset = [], 0
+        for v in values:
+            outputs.append(flat[offset:offset + np.size(v)].reshape(np.shape(v)))
+            offset += np.size(v)
+        return outputs
+
+    def gather(self, value):
+        '''The scalar `value` of every worker, as a float64 array indexed by rank.'''
+        if self.rank == 0:
+            self._memmap('gathered', 'w+', self.num_workers, np.float64)
+        self.barrier.wait()
+        gathered = self._memmap('gathered', 'r+', self.num_workers, np.float64)
+        gathered[self.rank] = value
+        gathered.flush()
+        self.barrier.wait()
+        values = np.array(gathered)
+        self.barrier.wait()
+        return values
+
+    def gather_objects(self, obj):
+        '''The picklable `obj` of every worker, as a list indexed by rank.'''
+        with open(os.path.join(self.directory, 'object-%d' % self.rank), 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.barrier.wait()
+        objects = []
+        for rank in range(self.num_workers):
+            with open(os.path.join(self.directory, 'object-%d' % rank), 'rb') as f:
+                objects.append(pickle.load(f))
+        self.barrier.wait()  # nobody may overwrite its file before everyone has read it
+        return objects
+
+    def in_sync(self, checksum):
+        '''True if every worker passed the same checksum.'''
+        checksums = self.gather(checksum)
+        return bool(np.all(checksums == checksums[0]))
+
+    def join(self):
+        '''Ends the workers; rank 0 waits for them and returns, the others exit here.'''
+        if self.rank != 0:
+            os._exit(0)
+        for pid in self.children:
+            os.waitpid(pid, 0)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def broadcast_variables(sess, allreduce):
+    '''Loads the values of rank 0 into the float32 variables of every worker.
+
+    The workers initialize (or restore) their variables independently, so
+    they have to start from the weights of one replica for the averaged
+    updates to keep them equal.
+    '''
+    variables = [var for var in tf.global_variables() if var.dtype.base_dtype == tf.float32]
+    for var, value in zip(variables, allreduce.broadcast(*sess.run(variables))):
+        var.load(value, sess)
+
+def check_replicas(sess, allreduce):
+    '''Raises if the trainable variables differ between the workers.'''
+    checksum = sum(np.sum(np.abs(value), dtype=np.float64) for value in sess.run(tf.trainable_variables()))
+    if not allreduce.in_sync(checksum):
+        raise RuntimeError('the data-parallel replicas diverged, worker %d has checksum %r'
+                           % (allreduce.rank, checksum))
+
+def allreduce_minimize(optimizer, loss, scope, allreduce):
+    '''Same as optimizer.minimize(loss) over the variables of `scope`, with the
+    gradients averaged across the data-parallel workers before they are applied.'''
+    grads_and_vars = [(g, v) for g, v in optimizer.compute_gradients(loss, var_list=tf.trainable_variables(scope + '/'))
+                      if g is not None]
+    grads = [tf.convert_to_tensor(g) for g, _ in grads_and_vars]
+    averaged = tf.py_func(allreduce.allreduce, grads, [tf.float32] * len(grads), stateful=True)
+    for avg, g in zip(averaged, grads):
+        avg.set_shape(g.get_shape())
+    return optimizer.apply_gradients(zip(averaged, [v for _, v in grads_and_vars]))
+
+def lazy_adam_minimize(learning_rate, loss, scope):
+    '''Adam over the variables of `scope`, lazy for the ones with sparse gradients.
+
+    Variables whose gradient is an IndexedSlices, the embedding tables read
+    with embedding_lookup or tf.gather, get tf.contrib.opt.LazyAdamOptimizer:
+    only the moments and values of the rows in the batch are updated, so the
+    step costs the batch size rather than the catalogue size. The rest keep
+    the dense AdamOptimizer.
+    '''
+    dense_optimizer = tf.train.AdamOptimizer(learning_rate)
+    grads_and_vars = [(g, v) for g, v in dense_optimizer.compute_gradients(loss, var_list=tf.trainable_variables(scope + '/'))
+                      if g is not None]
+    sparse = [(g, v) for g, v in grads_and_vars if isinstance(g, tf.IndexedSlices)]
+    dense = [(g, v) for g, v in grads_and_vars if not isinstance(g, tf.IndexedSlices)]
+    updates = [dense_optimizer.apply_gradients(dense)]
+    if sparse:
+        updates.append(tf.contrib.opt.LazyAdamOptimizer(learning_rate).apply_gradients(sparse))
+    return tf.group(*updates)
+
 # class Memory():
 #     def __init__(self):
 #         self.buffer = deque()